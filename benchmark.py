@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Command-line tool to measure the performance of the data load on a CSV data
+source, without making any API calls.
+"""
+import ast
+import json
+import sys
+import time
+import tracemalloc
+from itertools import islice
+
+from dataload.dataload_import import add_transformations
+from transformations import DATE_FORMATS, DateParser
+from utils.cli import BenchmarkArgumentParser
+from utils.reader import CsvBatchReader, CsvReader
+from utils.utils import count_lines_in_file, encode_json
+
+if sys.version_info[0] < 3:
+    sys.exit(1)
+
+
+def benchmark_batches(args):
+    """
+    Measure the memory used by the batches waiting for a worker, with the
+    regular and the compact batches. The memory allocated while the batches
+    are read is traced and reported per 1000 records held in memory.
+    """
+    print("Memory used by the batches in flight ({} records per batch)\n"
+          .format(args.batch_size))
+    for compact in (False, True):
+        reader = CsvBatchReader(args.data_file, args.batch_size,
+                                single_pass=True, compact_batches=compact)
+        reader.get_header()
+        add_transformations(reader)
+
+        tracemalloc.start()
+        batches = list(islice(reader, -(-args.records // args.batch_size)))
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        records = sum(batch.end_line - batch.start_line + 1
+                      for batch in batches)
+        print("\t{:<8} {:>8} records {:>10.1f} KB per 1000 records".format(
+            "compact" if compact else "regular", records,
+            memory / 1024 / records * 1000))
+
+
+def count_text_lines(file):
+    """
+    Previous implementation of count_lines_in_file(), iterating over the lines
+    of the file in text mode.
+    """
+    with open(file) as f:
+        return sum(1 for _ in f) - 1
+
+
+def benchmark_count(args):
+    """
+    Compare the time taken to count the records of the data file by iterating
+    over its lines in text mode and by counting the newlines of binary blocks,
+    with and without skipping the newlines of quoted fields.
+    """
+    print("Time to count the records of {}\n".format(args.data_file))
+    counters = (
+        ("text lines", count_text_lines),
+        ("blocks", count_lines_in_file),
+        ("quoted", lambda file: count_lines_in_file(file, quoted=True))
+    )
+    for name, counter in counters:
+        start_time = time.time()
+        count = counter(args.data_file)
+        elapsed = time.time() - start_time
+        print("\t{:<10} {:>10} records {:>8.3f}s".format(name, count,
+                                                          elapsed))
+
+
+def parse_date_strptime(value, formats):
+    """
+    Previous implementation of transform_date(), trying time.strptime() with
+    each format.
+    """
+    for try_format in formats:
+        try:
+            parsed_time = time.strptime(value.upper(), try_format)
+            return time.strftime("%Y-%m-%d %H:%M:%S", parsed_time)
+        except ValueError:
+            pass
+    raise ValueError("Could not parse date [{}]".format(value))
+
+
+def benchmark_dates(args):
+    """
+    Compare the time taken to parse the birthdays of the data file with
+    time.strptime() and with the DateParser, with the configured formats and
+    with other formats listed before them.
+    """
+    reader = CsvReader(args.data_file, single_pass=True)
+    dates = []
+    for row in islice(reader, args.records):
+        value = dict(zip(reader.header, row)).get("birthday")
+        if value:
+            dates.append(value)
+    print("Time to parse {} dates\n".format(len(dates)))
+
+    other_formats = ("%Y-%m-%d", "%d.%m.%Y", "%Y%m%dT%H%M%S%z")
+    for name, formats in (("formats", DATE_FORMATS),
+                          ("+3 formats", other_formats + DATE_FORMATS)):
+        start_time = time.time()
+        for value in dates:
+            parse_date_strptime(value, formats)
+        strptime_time = time.time() - start_time
+
+        parser = DateParser(formats)
+        start_time = time.time()
+        for value in dates:
+            parser.parse(value)
+        parser_time = time.time() - start_time
+
+        print("\t{:<10} strptime {:>8.3f}s   DateParser {:>8.3f}s".format(
+            name, strptime_time, parser_time))
+
+
+def decode_update_literal(text, plurals):
+    """
+    Previous decoding of a record saved for the delta migration as its repr(),
+    returning the values sent in the entity.update and entity.replace calls.
+    """
+    json_data = json.dumps(ast.literal_eval(text))
+    json_data_loaded = json.loads(json_data)
+    primary_key_value = json.dumps(json_data_loaded["email"])
+    json_loaded = json.loads(json_data)
+    json_loaded.pop("created", None)
+    json_data = json.dumps(json_loaded)
+    plural_values = [json.loads(json_data)[plural] for plural in plurals]
+    return primary_key_value, json_data, plural_values
+
+
+def decode_update_json(text, plurals):
+    """
+    Decoding of a record saved for the delta migration as JSON, returning the
+    values sent in the entity.update and entity.replace calls.
+    """
+    record = json.loads(text)
+    primary_key_value = json.dumps(record["email"])
+    json_data = json.dumps({key: value for key, value in record.items()
+                            if key != "created"})
+    plural_values = [record[plural] for plural in plurals]
+    return primary_key_value, json_data, plural_values
+
+
+def benchmark_json(args):
+    """
+    Compare the CPU time taken to transform and encode the records for the
+    API calls with the JSON columns decoded and with the JSON columns kept as
+    raw text, then to decode the records saved for the delta migration.
+    """
+    print("CPU time per record ({} records)\n".format(args.records))
+    for raw_json in (False, True):
+        reader = CsvBatchReader(args.data_file, args.batch_size,
+                                single_pass=True)
+        reader.get_header()
+        add_transformations(reader, raw_json=raw_json)
+        plurals = reader.get_plurals()
+
+        start_time = time.process_time()
+        records = []
+        for batch in islice(reader, -(-args.records // args.batch_size)):
+            encode_json(batch.records)
+            records.extend(batch.records)
+        import_time = time.process_time() - start_time
+
+        if raw_json:
+            saved = [encode_json(record) for record in records]
+            decode_update = decode_update_json
+        else:
+            saved = [str(record) for record in records]
+            decode_update = decode_update_literal
+        start_time = time.process_time()
+        for text in saved:
+            decode_update(text, plurals)
+        update_time = time.process_time() - start_time
+
+        print("\t{:<8} import {:>8.1f} us   update {:>8.1f} us".format(
+            "raw" if raw_json else "decoded",
+            import_time / len(records) * 1000000,
+            update_time / len(records) * 1000000))
+
+
+BENCHMARKS = {
+    'batches': benchmark_batches,
+    'count': benchmark_count,
+    'dates': benchmark_dates,
+    'json': benchmark_json
+}
+
+
+def main():
+    """ Main entry point for script being executed from the command line. """
+    parser = BenchmarkArgumentParser()
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,15 +7,21 @@ import datetime
 import json
 import logging
 import logging.config
+import os
 import sys
 import tempfile
+from functools import partial
 
 from utils.cli import DataLoadArgumentParser
 from dataload.dataload_finalize import dataload_finalize
 from dataload.dataload_import import dataload_import
 from dataload.dataload_update import dataload_update
-from utils.reader import CsvWriter
-from utils.utils import count_lines_in_file
+from utils.journal import BatchJournal, JournalError
+from utils.reader import CsvReader, CsvWriter, count_shard_records
+from utils.result_writer import (ResultWriter, get_result_log,
+                                 open_result_logs)
+from utils.session_api import SessionApi
+from utils.utils import STDIN, count_lines_in_file
 
 logger = logging.getLogger(__file__)
 
@@ -27,13 +33,20 @@ if sys.version_info[0] < 3:
 def set_logger_config(args, dataload_config):
     # Get the datetime formatted to use on filenames
     format_date = datetime.datetime.now().strftime("%b_%d_%Y_%H_%M_%S")
+    # Each shard has its own result files, merged once all the shards are
+    # loaded.
+    if args.shard:
+        format_date += "_shard{}of{}".format(*args.shard)
 
     # Setup logging based on the configuration in 'logging_config.json'.
     # See: https://docs.python.org/3/howto/logging.html
     with open("logging_config.json", 'r') as f:
         config = json.loads(f.read())
         # Define the final log filename, using the pattern on config.
-        log_handlers = ['success_handler', 'fail_handler']
+        log_handlers = {
+            "success_handler": "success_logger",
+            "fail_handler": "fail_logger"
+        }
         # Mapping for update handlers and loggers to be appended when using the
         # delta migration argument or removed if not.
         log_update = {
@@ -43,8 +56,7 @@ def set_logger_config(args, dataload_config):
 
         # Check if the delta migration is enable to add the logs.
         if args.delta_migration:
-            for key, value in log_update.items():
-                log_handlers.append(key)
+            log_handlers.update(log_update)
         else:
             # Remove the handlers and loggers before generate the files.
             # It's necessary to remove both to prevent any issue.
@@ -52,23 +64,21 @@ def set_logger_config(args, dataload_config):
                 del config["handlers"][key]
                 del config["loggers"][value]
 
-        for handler in log_handlers:
-            filename = config["handlers"][handler]["filename"]
-            filename_key = "{}_filename".format(handler)
-            config["handlers"][handler]["filename"] = filename.format(
-                format_date)
-            dataload_config.update({filename_key:
-                                   config["handlers"][handler]["filename"]})
+        # The result logs are written by a dedicated thread in large blocks
+        # instead of the logging handlers.
+        result_writer = ResultWriter(args.flush_interval)
+        filenames = open_result_logs(result_writer, config, log_handlers,
+                                     format_date)
+        for handler, filename in filenames.items():
+            dataload_config.update({"{}_filename".format(handler): filename})
+        dataload_config.update({'result_writer': result_writer})
 
     # Initialize the logging using the config
     logging.config.dictConfig(config)
 
-    # Initialize the loggers add header row the the success and failure
-    # CSV logs.
-    success_logger = logging.getLogger("success_logger")
-    fail_logger = logging.getLogger("fail_logger")
-    success_logger.info("batch,line,uuid,email")
-    fail_logger.info("batch,line,email,error")
+    # Add header row the the success and failure CSV logs.
+    get_result_log("success_logger").write("batch,line,uuid,email")
+    get_result_log("fail_logger").write("batch,line,email,error")
 
     # Update the dataload config with total records count
     prepare_pbar_total_records(args, dataload_config)
@@ -85,6 +95,8 @@ def set_logger_config(args, dataload_config):
     if args.delta_migration:
         prepare_delta_migration(dataload_config)
 
+    prepare_journal(args, dataload_config, format_date)
+
 
 def prepare_delta_migration(dataload_config):
     # The temporary file can't be delete, because we must use it to
@@ -100,17 +112,73 @@ def prepare_delta_migration(dataload_config):
     # Update the dataload config with tmp file writer
     dataload_config.update({'csv_tmp_writer': csv_tmp_writer})
 
-    # Initialize the update loggers and add header row the the success and
-    # failure CSV logs.
-    update_success_logger = logging.getLogger("update_success_logger")
-    update_fail_logger = logging.getLogger("update_fail_logger")
-    update_success_logger.info("batch,line,{}".format(args.primary_key))
-    update_fail_logger.info("batch,line,email,error")
+    # Add header row the the update success and failure CSV logs.
+    get_result_log("update_success_logger").write(
+        "batch,line,{}".format(args.primary_key))
+    get_result_log("update_fail_logger").write("batch,line,email,error")
+
+
+def prepare_journal(args, dataload_config, format_date):
+    # The journal of the batches completed can only be used to resume an
+    # import reading the same batches.
+    params = {
+        'data_file': args.data_file if args.data_file == STDIN
+        else os.path.abspath(args.data_file),
+        'type_name': args.type_name,
+        'batch_size': args.batch_size,
+        'max_batch_bytes': args.max_batch_bytes,
+        'start_at': args.start_at,
+        'shard': "{}/{}".format(*args.shard) if args.shard else None
+    }
+    update_file = None
+    if args.delta_migration:
+        update_file = dataload_config['csv_tmp_writer'].get_filename()
+    journal = BatchJournal('journal_{}.json'.format(format_date), params,
+                           args.batch_size, update_file, args.shard)
+
+    if args.resume:
+        try:
+            header = journal.load(args.resume)
+        except JournalError as error:
+            logger.error(str(error))
+            sys.exit(str(error))
+        logger.info("Resuming the import of {}: {} batches completed".format(
+            args.resume, journal.watermark + len(journal.entries)))
+        print("\tResuming the import after batch #{}, with {} more batches "
+              "completed\n".format(journal.watermark, len(journal.entries)))
+        # The batches in flight when the import stopped are sent again, the
+        # records they already created fail as duplicates without a success
+        # row.
+        warning = ("The batches after #{} missing from the journal are sent "
+                   "again: check their records in the fail log for duplicate "
+                   "errors, the records created before the interruption are "
+                   "not in any success log and cannot be rolled back"
+                   .format(journal.watermark))
+        logger.warning(warning)
+        print("\tWarning: {}\n".format(warning))
+
+        # The records to update found by the previous import are updated
+        # with the ones of this import.
+        previous_update_file = header.get('update_file')
+        if (args.delta_migration and previous_update_file and
+                os.path.exists(previous_update_file)):
+            reader = CsvReader(previous_update_file)
+            for row in reader:
+                dataload_config['csv_tmp_writer'].write_row(row)
+
+    journal.open()
+    dataload_config.update({'journal': journal})
 
 
 def prepare_pbar_total_records(args, dataload_config):
+    # In single pass mode the records are counted while they are loaded, the
+    # total is refined by the import as the file is read.
+    if args.single_pass:
+        dataload_config.update({'total_records': None})
+        return
+
     # Calculating total number of records to be processed and store metric
-    total_records = count_lines_in_file(args.data_file)
+    total_records = count_lines_in_file(args.data_file, quoted=True)
 
     if args.start_at > total_records:
         logger.info("No records to be imported after {}".format(
@@ -123,6 +191,10 @@ def prepare_pbar_total_records(args, dataload_config):
     if args.start_at > 1 and args.start_at <= total_records:
         total_records = (total_records - args.start_at) + 1
 
+    # Only the records of the batches of the shard are loaded.
+    total_records = count_shard_records(total_records, args.start_at,
+                                        args.batch_size, args.shard)
+
     dataload_config.update({'total_records': total_records})
 
 
@@ -130,7 +202,9 @@ if __name__ == "__main__":
     """ Main entry point for script being executed from the command line. """
     parser = DataLoadArgumentParser()
     args = parser.parse_args()
-    api = parser.init_api()
+    api = parser.init_api(api_class=partial(SessionApi,
+                                            pool_size=args.pool_size,
+                                            timeout=args.timeout))
 
     dataload_config = {
         'error_codes': {
@@ -148,8 +222,16 @@ if __name__ == "__main__":
         "configs": dataload_config
     }
 
-    dataload_import(**kwargs)
+    try:
+        dataload_import(**kwargs)
 
-    dataload_update(**kwargs)
+        dataload_update(**kwargs)
+    finally:
+        # The results queued by the workers are written and their batches
+        # journaled, even if the data load stops on an error.
+        dataload_config['result_writer'].close()
+        dataload_config['journal'].close()
 
     dataload_finalize(**kwargs)
+
+    api.close()
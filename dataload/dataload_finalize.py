@@ -3,16 +3,12 @@ File to handle the final output
 """
 import logging
 import logging.config
+import os
 
 from utils.utils import count_lines_in_file, delete_file
 
 logger = logging.getLogger(__file__)
 
-success_logger = logging.getLogger("success_logger")
-fail_logger = logging.getLogger("fail_logger")
-update_success_logger = logging.getLogger("update_success_logger")
-update_fail_logger = logging.getLogger("update_fail_logger")
-
 
 def dataload_finalize(args, api, configs):
     """
@@ -25,13 +21,58 @@ def dataload_finalize(args, api, configs):
     """
 
     logger.info("Checkign results")
-    print("\nDATALOAD RESULTS")
 
-    success_result = configs["success_handler_filename"]
-    fail_result = configs["fail_handler_filename"]
+    update_success_result = update_fail_result = None
+    # Delta migration is enable, get the update log files.
+    if args.delta_migration:
+        update_success_result = configs["update_success_handler_filename"]
+        update_fail_result = configs["update_fail_handler_filename"]
+
     retry_result = configs["csv_retry_writer"].get_filename()
+    result_files = print_results(configs['total_records'],
+                                 configs["success_handler_filename"],
+                                 configs["fail_handler_filename"],
+                                 retry_result, update_success_result,
+                                 update_fail_result)
+
+    # Remove the retry file if it is empty.
+    if retry_result not in result_files:
+        delete_file(retry_result, logger)
+
+    result = api.call('entity.count', type_name=args.type_name,
+                      timeout=args.timeout)
+    print("\t[{}] Total number of records in Entity Type [{}] after execution"
+          .format(result["total_count"], args.type_name))
+
+    print("\nPlease check detailed results in the files below:")
+    for file in result_files:
+        print("\t{}".format(file))
+
+    # The journal is only needed to resume an import that did not finish.
+    delete_file(configs['journal'].filename, logger)
 
-    print("\t[{}] Total processed users\n".format(configs['total_records']))
+
+def print_results(total_records, success_result, fail_result,
+                  retry_result=None, update_success_result=None,
+                  update_fail_result=None):
+    """
+    Print the number of records of each result file of an import.
+
+    Args:
+        total_records         - Number of records processed
+        success_result        - Path of the import success file
+        fail_result           - Path of the import failures file
+        retry_result          - Path of the retry file, if any
+        update_success_result - Path of the update success file of a delta
+                                migration
+        update_fail_result    - Path of the update failures file of a delta
+                                migration
+
+    Returns:
+        The list of the result files to check, without an empty retry file
+    """
+    print("\nDATALOAD RESULTS")
+    print("\t[{}] Total processed users\n".format(total_records))
 
     print("\t[{}] Import success. Number of new records inserted in database"
           .format(count_lines_in_file(success_result)))
@@ -39,23 +80,18 @@ def dataload_finalize(args, api, configs):
 
     result_files = [success_result, fail_result]
 
-    # If retry file is not empty, add it to the result list and print the info,
-    # otherwise, remove the file.
-    retry_line_number = count_lines_in_file(retry_result)
+    # If retry file is not empty, add it to the result list and print the info.
+    retry_line_number = 0
+    if retry_result and os.path.exists(retry_result):
+        retry_line_number = count_lines_in_file(retry_result, quoted=True)
     if retry_line_number > 0:
-        print("\t[{}] Import retries\n".format(count_lines_in_file(
-            retry_result)))
+        print("\t[{}] Import retries\n".format(retry_line_number))
         result_files.append(retry_result)
     else:
         print("\n")
-        retry_filename = configs["csv_retry_writer"].get_filename()
-        delete_file(retry_filename, logger)
 
-    # Delta migration is enable, get the update log files.
-    if args.delta_migration:
+    if update_success_result:
         # Append to an existing logger list.
-        update_success_result = configs["update_success_handler_filename"]
-        update_fail_result = configs["update_fail_handler_filename"]
         result_files.extend((update_success_result,
                              update_fail_result))
 
@@ -64,11 +100,4 @@ def dataload_finalize(args, api, configs):
         print("\t[{}] Update failures\n".format(count_lines_in_file(
             update_fail_result)))
 
-    result = api.call('entity.count', type_name=args.type_name,
-                      timeout=args.timeout)
-    print("\t[{}] Total number of records in Entity Type [{}] after execution"
-          .format(result["total_count"], args.type_name))
-
-    print("\nPlease check detailed results in the files below:")
-    for file in result_files:
-        print("\t{}".format(file))
+    return result_files
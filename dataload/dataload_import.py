@@ -4,28 +4,34 @@ File to handle the dataload import
 import logging
 import logging.config
 import time
-from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Lock
 
 import requests
 from janrain.capture import ApiResponseError
 from tqdm import tqdm
 
-from utils.reader import CsvBatchReader
-from utils.utils import rate_limiter
-from transformations import (transform_boolean, transform_date,
-                             transform_gender, transform_password,
-                             transform_plural)
+from utils.executor import create_executor
+from utils.limiter import AdaptiveConcurrency, TokenBucket
+from utils.ranges import CsvRangeReader
+from utils.reader import CompactCsvBatch, CsvBatchReader
+from utils.result_writer import get_result_log
+from utils.retry import RetryPolicy
+from utils.utils import STDIN, encode_json, get_compression
+from transformations import (transform_boolean_column, transform_date,
+                             transform_gender_column, transform_password,
+                             transform_password_raw, transform_plural,
+                             transform_plural_raw)
 
 logger = logging.getLogger(__file__)
 
-success_logger = logging.getLogger("success_logger")
-fail_logger = logging.getLogger("fail_logger")
+success_log = get_result_log("success_logger")
+fail_log = get_result_log("fail_logger")
 
 lock = Lock()
 success_count = 0
 fail_count = 0
 retry_count = 0
+split_count = 0
 
 
 def dataload_import(args, api, configs):
@@ -44,39 +50,69 @@ def dataload_import(args, api, configs):
     # loading large amounts of records this can result in a work queue that
     # uses up a very large amount of memory. The optimal queue size limit is
     # the nearly the same as the maximum concurrent API calls (API Limit).
-    # Setting as 2 times it to have an extra buffer.
+    # Setting as 2 times it to have an extra buffer. The reader waits for a
+    # worker to finish a batch when the queue is full.
     queue_maxsize = 2 * args.rate_limit
 
     # Metric to Progress bar(AVG per minute of imported records)
     start_time = time.time()
     configs["start_time"] = start_time
 
-    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+    executor, api, run = create_executor(args, api, queue_maxsize)
+
+    with executor:
         print("\tLoading data from {} into the '{}' entity type\n"
               .format(args.data_file, args.type_name))
 
         logger.info("Loading data from {} into the '{}' entity type"
                     .format(args.data_file, args.type_name))
+        if args.shard:
+            print("\tLoading the batches of shard {} of {}\n"
+                  .format(*args.shard))
+            logger.info("Loading the batches of shard {} of {}"
+                        .format(*args.shard))
 
         # Create a CSV "batch" reader which will read the CSV file in batches
         # of records converted to the JSON structure expected by the API.
-        print("\tValidating UTF-8 encoding and checking for Byte Order Mark\n")
-        reader = CsvBatchReader(args.data_file, args.batch_size, args.start_at)
+        if not args.single_pass:
+            print("\tValidating UTF-8 encoding and checking for Byte Order "
+                  "Mark\n")
+        # Compressed files and the standard input can't be memory mapped,
+        # they are read sequentially.
+        range_reader = args.range_reader
+        if range_reader and args.data_file == STDIN:
+            logger.warning("Reading from the standard input, the range reader "
+                           "is not used")
+            range_reader = False
+        elif range_reader and get_compression(args.data_file):
+            logger.warning("Compressed data file, the range reader is not "
+                           "used")
+            range_reader = False
+
+        if range_reader:
+            reader = CsvRangeReader(args.data_file, args.batch_size,
+                                    args.start_at,
+                                    single_pass=args.single_pass,
+                                    parse_workers=args.parse_workers,
+                                    max_batch_bytes=args.max_batch_bytes,
+                                    compact_batches=args.compact_batches,
+                                    shard=args.shard)
+        else:
+            reader = CsvBatchReader(args.data_file, args.batch_size,
+                                    args.start_at,
+                                    single_pass=args.single_pass,
+                                    build_index=args.build_index,
+                                    parse_workers=args.parse_workers,
+                                    max_batch_bytes=args.max_batch_bytes,
+                                    compact_batches=args.compact_batches,
+                                    shard=args.shard)
 
         # Add header to the retry file
         header = reader.get_header()
         csv_retry_writer = configs['csv_retry_writer']
         csv_retry_writer.write_row(header)
 
-        # Any column in the CSV file can have a "transformation" function
-        # defined to transform that data into the format needed for the API to
-        # consume that data. See the example transformations in the
-        # file: transformations.py
-        reader.add_transformation("password", transform_password)
-        reader.add_transformation("birthday", transform_date)
-        reader.add_transformation("gender", transform_gender)
-        reader.add_transformation("optIn.status", transform_boolean)
-        reader.add_transformation("clients", transform_plural)
+        add_transformations(reader, args.cache_size, args.raw_json)
 
         if args.delta_migration:
             # Get the plural fields to be updated
@@ -84,16 +120,20 @@ def dataload_import(args, api, configs):
             plurals_to_update = reader.get_plurals()
             configs.update({'plurals': plurals_to_update})
 
-        # Calculate minimum time per worker thread
-        if args.rate_limit > 0:
-            min_time = round(args.workers / args.rate_limit, 2)
-        else:
-            min_time = 0
-        logger.debug("Minimum processing time per worker: {}".format(min_time))
+        # All the worker threads take a token from the same bucket before
+        # making an API call.
+        limiter = TokenBucket(args.rate_limit, args.burst)
+        concurrency = AdaptiveConcurrency(args.workers, args.latency_target,
+                                          adaptive=args.adaptive)
+        # The batches failing with a retryable error are sent again by the
+        # worker before being written to the retry file.
+        retry = RetryPolicy(args.max_attempts, args.retry_delay,
+                            configs['error_codes'])
 
         # Iterate over batches of rows in the CSV and dispatch load_batch()
-        # calls to the worker threads.
-        futures = []
+        # calls to the worker threads. The executor does not keep the
+        # finished tasks, and raises the first uncaught exception of a worker
+        # without dispatching the next ones.
 
         # Progress Bar Legends
         print("Labels: Total Success(S) | Total Fails(F) | Total Retries(R) | \
@@ -103,34 +143,60 @@ Success Rate(SR) | Average Records per Minute(AVG)\n")
         # TQDM Progress Bar.
         pbar = tqdm(total=total_records, unit="rec")
         pbar.set_description("S:- F:- R:- SR:% AVG:-")
+        # The import being resumed is read from its checkpoint, the batches
+        # completed after it are skipped.
+        journal = configs['journal']
+        resumed_records = 0
+        if journal.checkpoint:
+            resumed_records = reader.resume_after(*journal.checkpoint)
+            logger.info("Reading {} after batch #{}, {} records were loaded "
+                        "before".format(args.data_file, journal.checkpoint[0],
+                                        resumed_records))
+            pbar.update(resumed_records)
+        skipped_batches = 0
         for batch in reader:
-            # Adjust throughput of items being added into the queue to optimize
-            # memory consumption
-            queue_size = executor._work_queue.qsize()
-
-            while queue_size >= queue_maxsize:
-                logger.debug("Maximum queue size reached, waiting 1 second.")
-                time.sleep(1)
-                queue_size = executor._work_queue.qsize()
-
-            logger.debug(batch.records)
-            logger.debug(batch.original_records)
-            kwargs = {
-                'api': api,
-                'batch': batch,
-                'args': args,
-                'configs': configs,
-                'min_time': min_time,
-                'pbar': pbar
-            }
-            futures.append(executor.submit(load_batch, **kwargs))
-
-        # Iterate over the future results to raise any uncaught exceptions.
-        # Note that this means uncaught exceptions will not be raised until
-        # AFTER all workers are dispatched.
+            if journal.is_completed(batch.id):
+                skipped_batches += 1
+                pbar.update(batch.end_line - batch.start_line + 1)
+                continue
+
+            # The total is unknown in single pass mode, estimate it from the
+            # amount of data read so far. There is no estimate when reading
+            # from the standard input.
+            if args.single_pass:
+                pbar.total = reader.estimate_total_records()
+                pbar.refresh()
+
+            # Logging the records of compact batches would build them here.
+            if not args.compact_batches:
+                logger.debug(batch.records)
+                logger.debug(batch.original_records)
+            executor.submit(run, load_batch(batch, args, configs, pbar), api,
+                            limiter, concurrency, retry)
+
         logger.info("Waiting for workers to finish")
-        for future in futures:
-            future.result()
+        executor.wait()
+        # The last batches are added to the journal once their results are
+        # written.
+        configs['result_writer'].flush()
+        journal.close()
+        if skipped_batches:
+            logger.info("{} batches completed by the resumed import were "
+                        "skipped".format(skipped_batches))
+        executor.log_stats()
+        limiter.log_stats()
+        concurrency.log_stats()
+        retry.log_stats()
+        api.log_stats()
+        if split_count:
+            logger.info("{} failed batches were split, making {} more API "
+                        "calls to isolate the records failing".format(
+                            split_count, 2 * split_count))
+
+        if args.single_pass:
+            configs["total_records"] = resumed_records + reader.records_read
+            pbar.total = configs["total_records"]
+            pbar.refresh()
         pbar.close()
 
         configs['csv_retry_writer'].close_file()
@@ -142,6 +208,35 @@ Success Rate(SR) | Average Records per Minute(AVG)\n")
             configs['csv_tmp_writer'].close_file()
 
 
+def add_transformations(reader, cache_size=None, raw_json=False):
+    """
+    Add the transformations of the CSV columns to a reader.
+
+    Args:
+        reader     - A utils.reader.CsvBatchReader instance
+        cache_size - Number of values cached for the transformations of the
+                     columns with repeated values, no cache if not set
+        raw_json   - Keep the JSON columns as the text of the CSV, spliced in
+                     the API calls instead of being decoded and encoded again
+    """
+    # Any column in the CSV file can have a "transformation" function
+    # defined to transform that data into the format needed for the API to
+    # consume that data. See the example transformations in the
+    # file: transformations.py
+    if raw_json:
+        reader.add_transformation("password", transform_password_raw)
+    else:
+        reader.add_transformation("password", transform_password)
+    reader.add_transformation("birthday", transform_date,
+                              cache_size=cache_size)
+    reader.add_transformation("gender", transform_gender_column)
+    reader.add_transformation("optIn.status", transform_boolean_column)
+    reader.add_transformation("clients",
+                              transform_plural_raw if raw_json
+                              else transform_plural,
+                              cache_size=cache_size)
+
+
 def log_error(batch, error_message):
     """
     Log a row to the failure CSV log file.
@@ -153,15 +248,14 @@ def log_error(batch, error_message):
     global fail_count
 
     try:
-        for i in range(len(batch.records)):
-            fail_logger.info("{},{},{},{}".format(
-                batch.id,
-                batch.start_line + i,
-                batch.records[i]['email'],
-                error_message
-            ))
-            with lock:
-                fail_count += 1
+        fail_log.write_lines(["{},{},{},{}".format(
+            batch.id,
+            batch.start_line + i,
+            batch.records[i]['email'],
+            error_message
+        ) for i in range(len(batch.records))])
+        with lock:
+            fail_count += len(batch.records)
     except Exception as error:
         logger.error(str(error))
 
@@ -195,32 +289,42 @@ def log_result(batch, result, delta_migration, configs):
         logger.error("Unexpected API response")
         return
 
+    # The lines of the batch are queued for the result writer at once, and
+    # the counters updated once.
+    success_lines = []
+    fail_lines = []
+    batch_fail_count = 0
     for i, uuid_result in enumerate(result['uuid_results']):
         if isinstance(uuid_result, dict) and uuid_result['stat'] == "error":
             # If error is unique_violation and delta_migration arg is
             # enable We must skip the fail log and use the update log file.
             if uuid_result['error'] == "unique_violation" and delta_migration:
-                configs['csv_tmp_writer'].write_row([batch.id,
-                                                    batch.start_line + i,
-                                                    batch.records[i]])
+                configs['csv_tmp_writer'].write_row([
+                    batch.id,
+                    batch.start_line + i,
+                    encode_json(batch.records[i])
+                ])
             else:
-                fail_logger.info("{},{},{},{}".format(
+                fail_lines.append("{},{},{},{}".format(
                     batch.id,
                     batch.start_line + i,
                     batch.records[i]['email'],
                     uuid_result['error_description']
                 ))
-            with lock:
-                fail_count += 1
+            batch_fail_count += 1
         else:
-            success_logger.info("{},{},{},{}".format(
+            success_lines.append("{},{},{},{}".format(
                 batch.id,
                 batch.start_line + i,
                 uuid_result,
                 batch.records[i]['email']
             ))
-            with lock:
-                success_count += 1
+
+    success_log.write_lines(success_lines)
+    fail_log.write_lines(fail_lines)
+    with lock:
+        success_count += len(success_lines)
+        fail_count += batch_fail_count
 
 
 def handle_exception(message, code, batch, configs, batch_size, type):
@@ -230,55 +334,145 @@ def handle_exception(message, code, batch, configs, batch_size, type):
     logger.warning(error_message)
 
     error_codes = configs['error_codes']
-    if code in error_codes[type] or type not in error_codes:
-        for _, record in enumerate(batch.original_records):
-            configs['csv_retry_writer'].write_row(record)
+    if type not in error_codes or code in error_codes[type]:
+        if isinstance(batch, CompactCsvBatch):
+            # The records are copied as they were read from the data file.
+            configs['csv_retry_writer'].write_lines(batch.lines)
+        else:
+            for _, record in enumerate(batch.original_records):
+                configs['csv_retry_writer'].write_row(record)
         with lock:
             retry_count += batch_size
-    else:
-        log_error(batch, message)
+        return "retry"
+    log_error(batch, message)
+    return "failed"
 
 
-def load_batch(api, batch, args, configs, min_time, pbar):
+def load_batch(batch, args, configs, pbar):
     """
     Call the entity.bulkCreate API endpoint to create a batch of user records.
+    The API calls are yielded to the function running the task, see
+    utils.executor.run_calls().
 
     Args:
-        api              - A janrain.capture.Api instance
         batch            - A utils.reader.CsvBatch instance
         args             - An dictionary with arguments
             type_name       - Entity type name (eg. "user")
             timeout         - Seconds for the HTTP timeout (10 recommended)
             dry_run         - Set to True to skip making API calls
             delta_migration - Set to True to update duplicate records
+            bisect_failures - Set to True to split the batches failing as a
+                              whole
         configs          - The dataload config dict for loggers and files
-        min_time         - Minimum number of seconds to wait before returning
+        pbar             - Progress bar object
     """
-    start_thread_time = time.time()
-
-    global success_count
-    global fail_count
-
     logger.info("Batch #{} (lines {}-{})"
                 .format(batch.id, batch.start_line, batch.end_line))
 
     if args.dry_run:
         log_error(batch, "Dry run. Record was skipped.")
+        outcome = "dry_run"
     else:
-        try:
-            result = api.call('entity.bulkCreate', type_name=args.type_name,
-                              timeout=args.timeout,
-                              all_attributes=batch.records)
-            log_result(batch, result, args.delta_migration, configs)
-        except ApiResponseError as error:
-            error_message = "API Error {}: {}".format(error.code, str(error))
-            handle_exception(error_message, error.code, batch, configs,
-                             args.batch_size, 'api')
-        except requests.HTTPError as error:
-            error_message = str(error)
-            error_code = error.response.status_code
-            handle_exception(error_message, error_code, batch, configs,
-                             args.batch_size, 'http')
+        outcome = yield from send_batch(batch, args, configs)
+    complete_batch(batch, outcome, configs)
+    update_progress(batch, configs, pbar)
+
+
+def send_batch(batch, args, configs):
+    """
+    Create the records of a batch and log the result. A batch failing as a
+    whole with an error that is not retried is split in two halves sent
+    again with the --bisect-failures argument, until the records failing are
+    isolated.
+
+    Returns:
+        The outcome of the batch: "created", "failed", "retry" or "split"
+    """
+    try:
+        result = yield 'entity.bulkCreate', {
+            'type_name': args.type_name,
+            'timeout': args.timeout,
+            'all_attributes': encode_json(batch.records)
+        }
+        log_result(batch, result, args.delta_migration, configs)
+        return "created"
+    except ApiResponseError as error:
+        error_message = "API Error {}: {}".format(error.code, str(error))
+        error_code = error.code
+        error_type = 'api'
+    except requests.HTTPError as error:
+        error_message = str(error)
+        error_code = error.response.status_code
+        error_type = 'http'
+    except requests.RequestException as error:
+        # Connection errors and timeouts which exhausted their attempts.
+        error_message = str(error)
+        error_code = None
+        error_type = 'connection'
+
+    if must_bisect(batch, error_code, error_type, args, configs):
+        for half in bisect_batch(batch, error_message):
+            yield from send_batch(half, args, configs)
+        return "split"
+    return handle_exception(error_message, error_code, batch, configs,
+                            len(batch.records), error_type)
+
+
+def complete_batch(batch, outcome, configs):
+    """
+    Record a batch as completed in the journal once its results are written,
+    so that a resumed import does not lose them. The entry is added by the
+    result writer thread after it flushes the result logs.
+    """
+    configs['result_writer'].when_written(journal_batch, batch, outcome,
+                                          configs)
+
+
+def journal_batch(batch, outcome, configs):
+    """
+    Add a completed batch to the journal, once its records written to the
+    retry and update files are flushed.
+    """
+    configs['csv_retry_writer'].flush()
+    if 'csv_tmp_writer' in configs:
+        configs['csv_tmp_writer'].flush()
+    configs['journal'].add(batch, outcome)
+
+
+def must_bisect(batch, code, type, args, configs):
+    """
+    Tell if a batch that failed as a whole must be split to isolate the
+    records failing: the error is not retried and the batch has more than one
+    record.
+    """
+    error_codes = configs['error_codes']
+    return (args.bisect_failures and len(batch.records) > 1 and
+            type in error_codes and code not in error_codes[type])
+
+
+def bisect_batch(batch, error_message):
+    """
+    Split a batch in two halves keeping its batch number, the line numbers of
+    the records are kept by the halves.
+
+    Returns:
+        A tuple with the two utils.reader.CsvBatch instances
+    """
+    global split_count
+
+    logger.warning("Splitting Batch #{} (lines {}-{}) after: {}".format(
+        batch.id, batch.start_line, batch.end_line, error_message))
+    with lock:
+        split_count += 1
+    half = len(batch.records) // 2
+    return (batch.slice(0, half, batch.id),
+            batch.slice(half, len(batch.records), batch.id))
+
+
+def update_progress(batch, configs, pbar):
+    """
+    Update the progress bar with the records of a batch and the totals.
+    """
     pbar.update(len(batch.records))
     end_time = time.time()
     start_time = configs["start_time"]
@@ -301,7 +495,3 @@ def load_batch(api, batch, args, configs, min_time, pbar):
             success_rate,
             avg_records_per_min
         ))
-
-    # As a very crude rate limiting mechanism, sleep if processing the batch
-    # did not use all of the minimum time.
-    rate_limiter(start_thread_time, min_time)
@@ -1,26 +1,27 @@
 """
 File to handle the records update in case script was executed with delta flag
 """
-import ast
 import json
 import logging
 import logging.config
-import time
-from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Lock
 
 import requests
 from janrain.capture import ApiResponseError
 from tqdm import tqdm
 
+from utils.executor import create_executor
+from utils.limiter import AdaptiveConcurrency, TokenBucket
 from utils.reader import CsvReader
-from utils.utils import count_lines_in_file, delete_file, rate_limiter
+from utils.result_writer import get_result_log
+from utils.retry import RetryPolicy
+from utils.utils import count_lines_in_file, delete_file
 
 logger = logging.getLogger(__file__)
 
 
-update_success_logger = logging.getLogger("update_success_logger")
-update_fail_logger = logging.getLogger("update_fail_logger")
+update_success_log = get_result_log("update_success_logger")
+update_fail_log = get_result_log("update_fail_logger")
 
 lock = Lock()
 success_count = 0
@@ -49,7 +50,7 @@ def dataload_update(args, api, configs):
     logger.info("Checking if there are any duplicate records to update")
     print("\tChecking if there are any duplicate records to update\n")
     data_file = configs['csv_tmp_writer'].get_filename()
-    record_update_count = count_lines_in_file(data_file)
+    record_update_count = count_lines_in_file(data_file, quoted=True)
     plurals = configs['plurals']
 
     # Check if there is any record to be updated. If none, delete the temporary
@@ -62,16 +63,25 @@ def dataload_update(args, api, configs):
     print("\t{} duplicate records were found and will be updated\n"
           .format(record_update_count))
 
-    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+    # Only a limited number of records wait for a worker, so that the records
+    # are not all read into memory beforehand. See dataload_import().
+    queue_maxsize = 2 * args.rate_limit
+
+    executor, api, run = create_executor(args, api, queue_maxsize)
+
+    with executor:
         logger.info("Loading data from TEMP file into the '{}' entity type."
                     .format(args.type_name))
 
-        # Calculate minimum time per worker thread
-        min_time = 0
-        if args.rate_limit > 0:
-            min_time = round(args.workers / args.rate_limit, 2)
-
-        logger.debug("Minimum processing time per worker: {}".format(min_time))
+        # All the worker threads take a token from the same bucket before
+        # making an API call.
+        limiter = TokenBucket(args.rate_limit, args.burst)
+        concurrency = AdaptiveConcurrency(args.workers, args.latency_target,
+                                          adaptive=args.adaptive)
+        # The API calls failing with a retryable error are made again by the
+        # worker before the record is logged as failed.
+        retry = RetryPolicy(args.max_attempts, args.retry_delay,
+                            configs['error_codes'])
 
         print("\tValidating UTF-8 encoding and checking for Byte Order Mark\n")
         # Create a CSV reader which will read the CSV TEMP file and return
@@ -83,8 +93,9 @@ def dataload_update(args, api, configs):
         pbar.set_description("Updating Records.")
 
         # Iterate over records of rows in the CSV and dispatch update_record()
-        # calls to the worker threads.
-        futures = []
+        # calls to the worker threads. The executor does not keep the
+        # finished tasks, and raises the first uncaught exception of a worker
+        # without dispatching the next ones.
         for _, row in enumerate(reader):
             logger.debug(row)
             record_info = {
@@ -93,22 +104,17 @@ def dataload_update(args, api, configs):
                 'line': row[1]
             }
 
-            kwargs = {
-                'api': api,
-                'args': args,
-                'record_info': record_info,
-                'min_time': min_time,
-                'pbar': pbar,
-                'plurals': plurals
-            }
-            futures.append(executor.submit(update_record, **kwargs))
+            executor.submit(run, update_record(args, record_info, pbar,
+                                               plurals),
+                            api, limiter, concurrency, retry)
 
-        # Iterate over the future results to raise any uncaught exceptions.
-        # Note that this means uncaught exceptions will not be raised until
-        # AFTER all workers are dispatched.
         logger.info("Waiting for workers to finish")
-        for future in futures:
-            future.result()
+        executor.wait()
+        executor.log_stats()
+        limiter.log_stats()
+        concurrency.log_stats()
+        retry.log_stats()
+        api.log_stats()
 
         pbar.close()
         logger.info("Update finished!")
@@ -117,63 +123,62 @@ def dataload_update(args, api, configs):
         delete_file(data_file, logger)
 
 
-def update_record(api, args, record_info, min_time, pbar, plurals):
+def update_record(args, record_info, pbar, plurals):
     """
-    Call the entity.update API endpoint to update user record.
+    Call the entity.update API endpoint to update user record. The API calls
+    are yielded to the function running the task, see
+    utils.executor.run_calls().
 
     Args:
-        api              - A janrain.capture.Api instance
         args             - An dictionary with arguments
             type_name       - Entity type name (eg. "user")
             timeout         - Seconds for the HTTP timeout (10 recommended)
             dry_run         - Set to True to skip making API calls
             delta_migration - Set to True to update duplicate records
         record_info      - A dict with original record info.
-        min_time         - Minimum number of seconds to wait before returning
         pbar             - Progress bar object
         plurals          - A list with plural fields that must be updated
     """
-
-    start_thread_time = time.time()
-
     global success_count
     global fail_count
 
-    # Convert the record into a dict so we can use just one argument.
-    json_data = json.dumps(ast.literal_eval(record_info['record']))
-    json_data_loaded = json.loads(json_data)
+    # The record was saved as JSON by the import, it is decoded only once.
+    record = json.loads(record_info['record'])
     row = {
         'id': record_info['batch_id'],
         'start_line': record_info['line'],
-        'primary_key': args.primary_key,
-        'record': [json_data],
-        'email': json_data_loaded['email']
+        'email': record['email']
     }
     try:
         # We must prepare the data before try to update the record.
-        primary_key = json_data_loaded[args.primary_key]
+        primary_key = record[args.primary_key]
+        row['primary_key_value'] = primary_key
         primary_key_value = json.dumps(primary_key)
-        json_data = prepare_update_record(json_data)
+        json_data = prepare_update_record(record)
         results = []
 
-        result_update = api.call('entity.update', type_name=args.type_name,
-                                 key_value=primary_key_value,
-                                 key_attribute=args.primary_key,
-                                 timeout=args.timeout, value=json_data)
+        result_update = yield 'entity.update', {
+            'type_name': args.type_name,
+            'key_value': primary_key_value,
+            'key_attribute': args.primary_key,
+            'timeout': args.timeout,
+            'value': json_data
+        }
         results.append(result_update)
 
         # Loop into plurals to update with new values
         for plural in plurals:
-            plural_value = json.loads(json_data)[plural]
+            plural_value = record[plural]
 
             # Update the entire list since data has not primary key of plural.
-            result_replace = api.call('entity.replace',
-                                      type_name=args.type_name,
-                                      key_value=primary_key_value,
-                                      key_attribute=args.primary_key,
-                                      timeout=args.timeout,
-                                      attribute_name=plural,
-                                      value=plural_value)
+            result_replace = yield 'entity.replace', {
+                'type_name': args.type_name,
+                'key_value': primary_key_value,
+                'key_attribute': args.primary_key,
+                'timeout': args.timeout,
+                'attribute_name': plural,
+                'value': plural_value
+            }
             results.append(result_replace)
 
         log_result(row, results)
@@ -182,21 +187,26 @@ def update_record(api, args, record_info, min_time, pbar, plurals):
             error.code, str(error), record_info['line'])
         logger.warning(error_message)
         log_error(row, error_message)
-    except requests.HTTPError as error:
+    except requests.RequestException as error:
+        # HTTP errors, and connection errors or timeouts which exhausted
+        # their attempts.
         error_message = "{} on Line #{}".format(str(error),
                                                 record_info['line'])
         logger.warning(error_message)
         log_error(row, str(error))
+    update_progress(pbar)
+
+
+def update_progress(pbar):
+    """
+    Update the progress bar with a record and the totals.
+    """
     pbar.update(1)
     pbar.set_description("Success:{} Fail:{}".format(
         success_count,
         fail_count
     ))
 
-    # As a very crude rate limiting mechanism, sleep if processing the batch
-    # did not use all of the minimum time.
-    rate_limiter(start_thread_time, min_time)
-
 
 def log_error(row, error_message):
     """
@@ -209,7 +219,7 @@ def log_error(row, error_message):
     global fail_count
 
     try:
-        update_fail_logger.info("{},{},{},{}".format(
+        update_fail_log.write("{},{},{},{}".format(
             row['id'],
             row['start_line'],
             row['email'],
@@ -223,15 +233,16 @@ def log_error(row, error_message):
 
 def prepare_update_record(record):
     """
-    Remove unecessary/forbidden attributes from record so it's possible to
-    reuse on the entity.update API call.
+    Encode the record without the unecessary/forbidden attributes so it's
+    possible to reuse on the entity.update API call. The record is not
+    modified.
     """
-    json_loaded = json.loads(record)
+    record = dict(record)
     not_allowed_keys = ['created']
 
     for key in not_allowed_keys:
-        del json_loaded[key]
-    return json.dumps(json_loaded)
+        del record[key]
+    return json.dumps(record)
 
 
 def result_has_error(results):
@@ -275,7 +286,7 @@ def log_result(row, results):
     if error_stat:
         logger.error(error_msg)
     elif error_result:
-        update_fail_logger.info("{},{},{},{}".format(
+        update_fail_log.write("{},{},{},{}".format(
             row['id'],
             row['start_line'],
             row['email'],
@@ -284,11 +295,10 @@ def log_result(row, results):
         with lock:
             fail_count += 1
     else:
-        record = json.loads(row['record'][0])
-        update_success_logger.info("{},{},{}".format(
+        update_success_log.write("{},{},{}".format(
             row['id'],
             row['start_line'],
-            record[row['primary_key']]
+            row['primary_key_value']
         ))
         with lock:
             success_count += 1
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Command-line tool to build the record offset index of a CSV data source. The
+index is saved next to the data file and used by dataload to seek straight to
+the record given with --start-at.
+"""
+import sys
+
+from tqdm import tqdm
+
+from utils.cli import IndexArgumentParser
+from utils.index import RecordIndex
+from utils.reader import CsvReader
+
+if sys.version_info[0] < 3:
+    sys.exit(1)
+
+
+def main():
+    """ Main entry point for script being executed from the command line. """
+    parser = IndexArgumentParser()
+    args = parser.parse_args()
+
+    # The encoding is validated while the index is built.
+    reader = CsvReader(args.data_file, single_pass=True, build_index=True)
+    reader.index_stride = args.stride
+
+    # TQDM Progress Bar.
+    pbar = tqdm(unit="rec")
+    pbar.set_description("Indexing Records")
+    try:
+        for _ in reader:
+            pbar.update(1)
+    except UnicodeDecodeError as error:
+        print("Error on indexing the data file. Exception: {}".format(error))
+        sys.exit(1)
+    finally:
+        pbar.close()
+
+    print("\nPlease check the generated index file below:")
+    print("\t{}".format(RecordIndex(args.data_file).filename))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Command-line tool to merge the result files of the shards of an import, loaded
+in parallel with dataload --shard, and print the results of the whole import.
+"""
+import datetime
+import os
+import shutil
+import sys
+
+from dataload.dataload_finalize import print_results
+from utils.cli import MergeArgumentParser
+from utils.utils import count_lines_in_file
+
+if sys.version_info[0] < 3:
+    sys.exit(1)
+
+# Prefixes of the result files, the update files first since their prefix
+# starts like the one of the import files.
+RESULT_KINDS = ["update_success", "update_fail", "success", "fail", "retry"]
+
+
+def result_kind(filename):
+    """
+    Returns the kind of a result file from its name, or None.
+    """
+    name = os.path.basename(filename)
+    for kind in RESULT_KINDS:
+        if name.startswith(kind + "_"):
+            return kind
+    return None
+
+
+def merge_files(filenames, merged_filename):
+    """
+    Concatenate result files with the same header into a file with the header
+    once.
+
+    Args:
+        filenames       - Paths of the result files, in the order merged
+        merged_filename - Path of the merged file
+
+    Raises:
+        ValueError if the files don't have the same header
+    """
+    header = None
+    with open(merged_filename, "wb") as merged:
+        for filename in filenames:
+            with open(filename, "rb") as f:
+                file_header = f.readline()
+                if header is None:
+                    header = file_header
+                    merged.write(header)
+                elif file_header != header:
+                    raise ValueError("The header of {} is not the same as the "
+                                     "one of {}".format(filename,
+                                                        filenames[0]))
+                shutil.copyfileobj(f, merged)
+
+                # The next file must start on a new line.
+                if f.tell() > len(file_header):
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        merged.write(b"\n")
+
+
+def main():
+    """ Main entry point for script being executed from the command line. """
+    parser = MergeArgumentParser()
+    args = parser.parse_args()
+
+    result_files = {}
+    for filename in args.result_files:
+        kind = result_kind(filename)
+        if kind is None:
+            parser.error("not a result file: {}".format(filename))
+        result_files.setdefault(kind, []).append(filename)
+    if "success" not in result_files or "fail" not in result_files:
+        parser.error("the success and fail files of the shards are required")
+    if ("update_success" in result_files) != ("update_fail" in result_files):
+        parser.error("the update success and update fail files of the shards "
+                     "are both required")
+
+    format_date = datetime.datetime.now().strftime("%b_%d_%Y_%H_%M_%S")
+    merged = {}
+    for kind, filenames in result_files.items():
+        merged[kind] = os.path.join(args.output_dir, "{}_{}.csv".format(
+            kind, format_date))
+        try:
+            merge_files(filenames, merged[kind])
+        except (OSError, ValueError) as error:
+            sys.exit("Error on merging the result files: {}".format(error))
+
+    # Every record processed by a shard is in one of the result files.
+    total_records = sum(count_lines_in_file(merged[kind])
+                        for kind in merged if kind != "retry")
+    if "retry" in merged:
+        total_records += count_lines_in_file(merged["retry"], quoted=True)
+
+    print("\nMerged the result files of {} shards".format(
+        len(result_files["success"])))
+    merged_files = print_results(total_records, merged["success"],
+                                 merged["fail"], merged.get("retry"),
+                                 merged.get("update_success"),
+                                 merged.get("update_fail"))
+
+    print("\nPlease check detailed results in the files below:")
+    for file in merged_files:
+        print("\t{}".format(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,9 +9,13 @@ import json
 import logging
 import logging.config
 import sys
+from functools import partial
 
 from utils.utils import count_lines_in_file
 from utils.cli import RollbackArgumentParser
+from utils.result_writer import (ResultWriter, get_result_log,
+                                 open_result_logs)
+from utils.session_api import SessionApi
 from rollback.dataload_rollback import dataload_rollback, finalize
 
 logger = logging.getLogger(__file__)
@@ -20,11 +24,7 @@ if sys.version_info[0] < 3:
     logger.error("Error: dataload_rollback requires Python 3.")
     sys.exit(1)
 
-success_logger = logging.getLogger("success_rollback_logger")
-fail_logger = logging.getLogger("fail_rollback_logger")
-
-
-def setup_logging():
+def setup_logging(args):
     dataload_config = {}
     logging_config_file = "logging_rollback_config.json"
 
@@ -36,22 +36,25 @@ def setup_logging():
         format_date = datetime.datetime.now().strftime("%b_%d_%Y_%H_%M_%S")
 
         # Define the final log filename, using the pattern on config.
-        log_handlers = ['success_rollback_handler', 'fail_rollback_handler']
-
-        for handler in log_handlers:
-            filename = config["handlers"][handler]["filename"]
-            filename_key = "{}_filename".format(handler)
-            config["handlers"][handler]["filename"] = filename.format(
-                format_date)
-            dataload_config.update({
-                filename_key: config["handlers"][handler]["filename"]
-            })
+        log_handlers = {
+            "success_rollback_handler": "success_rollback_logger",
+            "fail_rollback_handler": "fail_rollback_logger"
+        }
+
+        # The result logs are written by a dedicated thread in large blocks
+        # instead of the logging handlers.
+        result_writer = ResultWriter(args.flush_interval)
+        filenames = open_result_logs(result_writer, config, log_handlers,
+                                     format_date)
+        for handler, filename in filenames.items():
+            dataload_config.update({"{}_filename".format(handler): filename})
+        dataload_config.update({'result_writer': result_writer})
 
     logging.config.dictConfig(config)
 
     # Add header row the the success and failure CSV logs
-    success_logger.info("batch,line,uuid,email")
-    fail_logger.info("batch,line,error")
+    get_result_log("success_rollback_logger").write("batch,line,uuid,email")
+    get_result_log("fail_rollback_logger").write("batch,line,error")
 
     return dataload_config
 
@@ -60,12 +63,20 @@ if __name__ == "__main__":
     """ Main entry point for script being executed from the command line. """
     parser = RollbackArgumentParser()
     args = parser.parse_args()
-    api = parser.init_api()
-
-    dataload_config = setup_logging()
+    api = parser.init_api(api_class=partial(SessionApi,
+                                            pool_size=args.pool_size,
+                                            timeout=args.timeout))
+
+    dataload_config = setup_logging(args)
+    dataload_config.update({
+        'error_codes': {
+            'api': [403, 500, 504, 510],
+            'http': [403, 500, 501, 502]
+        }
+    })
 
     # Calculating total number of records to be processed and store metric
-    total_records = count_lines_in_file(args.data_file)
+    total_records = count_lines_in_file(args.data_file, quoted=True)
 
     dataload_config.update({'total_records': total_records})
 
@@ -75,5 +86,11 @@ if __name__ == "__main__":
         "configs": dataload_config
     }
 
-    dataload_rollback(**kwargs)
+    try:
+        dataload_rollback(**kwargs)
+    finally:
+        # The results queued by the workers are written even if the rollback
+        # stops on an error.
+        dataload_config['result_writer'].close()
     finalize(**kwargs)
+    api.close()
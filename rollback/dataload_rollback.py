@@ -4,21 +4,23 @@ File to handle the rollback process in order to delete users added.
 
 import logging
 import logging.config
-import time
-from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Lock
 
 import requests
 from janrain.capture import ApiResponseError
 from tqdm import tqdm
 
+from utils.executor import create_executor
+from utils.limiter import AdaptiveConcurrency, TokenBucket
 from utils.reader import CsvReader
-from utils.utils import count_lines_in_file, rate_limiter
+from utils.result_writer import get_result_log
+from utils.retry import RetryPolicy
+from utils.utils import count_lines_in_file
 
 logger = logging.getLogger(__file__)
 
-success_logger = logging.getLogger("success_rollback_logger")
-fail_logger = logging.getLogger("fail_rollback_logger")
+success_log = get_result_log("success_rollback_logger")
+fail_log = get_result_log("fail_rollback_logger")
 
 lock = Lock()
 success_count = 0
@@ -37,9 +39,15 @@ def dataload_rollback(args, api, configs):
     print("\n\nStarting the rollback process.\n")
 
     data_file = args.data_file
-    record_count = count_lines_in_file(data_file)
+    record_count = count_lines_in_file(data_file, quoted=True)
 
-    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+    # Only a limited number of records wait for a worker, so that the records
+    # are not all read into memory beforehand. See dataload_import().
+    queue_maxsize = 2 * args.rate_limit
+
+    executor, api, run = create_executor(args, api, queue_maxsize)
+
+    with executor:
         logger.info("Loading data from file into the '{}' entity type."
                     .format(args.type_name))
 
@@ -51,46 +59,44 @@ def dataload_rollback(args, api, configs):
         pbar = tqdm(total=record_count, unit="rec")
         pbar.set_description("Delete Records.")
 
-        # Calculate minimum time per worker thread
-        if args.rate_limit > 0:
-            min_time = round(args.workers / args.rate_limit, 2)
-        else:
-            min_time = 0
-        logger.debug("Minimum processing time per worker: {}".format(min_time))
+        # All the worker threads take a token from the same bucket before
+        # making an API call.
+        limiter = TokenBucket(args.rate_limit, args.burst)
+        # The deletions are not limited beyond the number of workers.
+        concurrency = AdaptiveConcurrency(args.workers, args.timeout,
+                                          adaptive=False)
+        # The deletions failing with a retryable error are made again by the
+        # worker before the record is logged as failed.
+        retry = RetryPolicy(args.max_attempts, args.retry_delay,
+                            configs['error_codes'])
 
         # Iterate over records of rows in the CSV and dispatch delete_record()
-        # calls to the worker threads.
-        futures = []
+        # calls to the worker threads. The executor does not keep the
+        # finished tasks, and raises the first uncaught exception of a worker
+        # without dispatching the next ones.
         for _, row in enumerate(reader):
-            kwargs = {
-                'api': api,
-                'args': args,
-                'uuid': row[2],
-                'email': row[3],
-                'batch_id': row[0],
-                'line': row[1],
-                'pbar': pbar,
-                'min_time': min_time
-            }
-            futures.append(executor.submit(delete_record, **kwargs))
+            executor.submit(run, delete_record(args, row[2], row[3], row[0],
+                                               row[1], pbar),
+                            api, limiter, concurrency, retry)
 
-        # Iterate over the future results to raise any uncaught exceptions.
-        # Note that this means uncaught exceptions will not be raised until
-        # AFTER all workers are dispatched.
         logger.info("Waiting for workers to finish")
-        for future in futures:
-            future.result()
+        executor.wait()
+        executor.log_stats()
+        limiter.log_stats()
+        retry.log_stats()
+        api.log_stats()
 
         pbar.close()
         logger.info("Rollback finished!")
 
 
-def delete_record(api, args, uuid, email, batch_id, line, pbar, min_time):
+def delete_record(args, uuid, email, batch_id, line, pbar):
     """
-    Call the entity.delete API endpoint to delete the user record.
+    Call the entity.delete API endpoint to delete the user record. The API
+    call is yielded to the function running the task, see
+    utils.executor.run_calls().
 
     Args:
-        api              - A janrain.capture.Api instance
         args             - An dictionary with arguments
             type_name       - Entity type name (eg. "user")
             timeout         - Seconds for the HTTP timeout (10 recommended)
@@ -99,9 +105,6 @@ def delete_record(api, args, uuid, email, batch_id, line, pbar, min_time):
         line             - Original file line
         pbar             - Progress bar object
     """
-
-    start_thread_time = time.time()
-
     global success_count
     global fail_count
     results = []
@@ -117,12 +120,11 @@ def delete_record(api, args, uuid, email, batch_id, line, pbar, min_time):
             log_error(row, "Dry run. Skipping delete call.")
             logger.debug("Dry run mode detected. Skipping delete call.")
         else:
-            result_delete = api.call(
-                'entity.delete',
-                type_name=args.type_name,
-                uuid=uuid,
-                timeout=args.timeout
-            )
+            result_delete = yield 'entity.delete', {
+                'type_name': args.type_name,
+                'uuid': uuid,
+                'timeout': args.timeout
+            }
 
             results.append(result_delete)
             log_result(row, results)
@@ -131,20 +133,25 @@ def delete_record(api, args, uuid, email, batch_id, line, pbar, min_time):
         error_message = "API Error {}: {}".format(error.code, str(error))
         logger.warning(error_message)
         log_error(row, error_message)
-    except requests.HTTPError as error:
+    except requests.RequestException as error:
+        # HTTP errors, and connection errors or timeouts which exhausted
+        # their attempts.
         logger.warning(str(error))
         log_error(row, str(error))
 
+    update_progress(pbar)
+
+
+def update_progress(pbar):
+    """
+    Update the progress bar with a record and the totals.
+    """
     pbar.update(1)
     pbar.set_description("Success:{} Fail:{}".format(
         success_count,
         fail_count
     ))
 
-    # As a very crude rate limiting mechanism, sleep if processing the batch
-    # did not use all of the minimum time.
-    rate_limiter(start_thread_time, min_time)
-
 
 def log_error(row, error_message):
     """
@@ -157,7 +164,7 @@ def log_error(row, error_message):
     global fail_count
 
     try:
-        fail_logger.info("{},{},{}".format(
+        fail_log.write("{},{},{}".format(
             row['id'],
             row['start_line'],
             error_message
@@ -212,7 +219,7 @@ def log_result(row, results):
         return
 
     if error_result:
-        fail_logger.info("{},{},{}".format(
+        fail_log.write("{},{},{}".format(
             row['id'],
             row['start_line'],
             error_msg
@@ -221,7 +228,7 @@ def log_result(row, results):
             fail_count += 1
         return
 
-    success_logger.info("{},{},{},{}".format(
+    success_log.write("{},{},{},{}".format(
         row['id'],
         row['start_line'],
         row['uuid'],
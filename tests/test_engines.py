@@ -0,0 +1,207 @@
+"""
+Data load against a local HTTP server standing in for the Capture API, with
+the thread and the asyncio engines. Both engines must make the same API calls
+and write the same result files.
+"""
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Records of the data file, the emails repeated are created once and then
+# updated with --delta-migration.
+RECORDS = 45
+DUPLICATES = 8
+
+
+class CaptureHandler(BaseHTTPRequestHandler):
+    """
+    Handles the entity.bulkCreate, entity.update, entity.replace,
+    entity.delete and entity.count calls. The UUID of a record is derived
+    from its email, so that the result files of two runs can be compared.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        params = {name: values[0] for name, values in
+                  parse_qs(body.decode(), keep_blank_values=True).items()}
+        api_call = self.path.strip("/")
+        server = self.server
+        with server.lock:
+            server.calls.append(api_call)
+            if api_call == "entity.bulkCreate":
+                results = []
+                for record in json.loads(params["all_attributes"]):
+                    if record["email"] in server.uuids.values():
+                        results.append({"stat": "error",
+                                        "error": "unique_violation",
+                                        "error_description": "duplicate"})
+                        continue
+                    record_uuid = str(uuid.uuid5(uuid.NAMESPACE_URL,
+                                                 record["email"]))
+                    server.uuids[record_uuid] = record["email"]
+                    results.append(record_uuid)
+                response = {"stat": "ok", "uuid_results": results}
+            elif api_call in ("entity.update", "entity.replace"):
+                server.updates.append((api_call, params["key_value"],
+                                       params.get("attribute_name"),
+                                       json.loads(params["value"])))
+                response = {"stat": "ok"}
+            elif api_call == "entity.delete":
+                if server.uuids.pop(params["uuid"], None) is None:
+                    response = {"stat": "error", "code": 310,
+                                "error": "record_not_found",
+                                "error_description": "no such record"}
+                else:
+                    response = {"stat": "ok"}
+            elif api_call == "entity.count":
+                response = {"stat": "ok", "total_count": len(server.uuids)}
+            else:
+                response = {"stat": "error", "code": 403,
+                            "error": "unknown_endpoint",
+                            "error_description": api_call}
+        data = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class CaptureServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), CaptureHandler)
+        self.lock = threading.Lock()
+        self.calls = []
+        self.updates = []
+        self.uuids = {}
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+
+def write_data_file(filename):
+    with open(filename, "w") as f:
+        f.write("email,givenName,clients,created\n")
+        for i in range(RECORDS):
+            # The last records repeat the emails of the first ones.
+            number = i % (RECORDS - DUPLICATES)
+            clients = json.dumps([{"clientId": str(i), "name": "Client"}])
+            f.write('user{}@example.com,Name {},"{}",2020-01-01 00:00:00\n'
+                    .format(number, i, clients.replace('"', '""')))
+
+
+def read_results(directory, prefix):
+    """
+    Returns the header and the sorted lines of a result file.
+    """
+    filenames = glob.glob(os.path.join(directory, prefix + "_*.csv"))
+    if len(filenames) != 1:
+        raise AssertionError("{} {} files in {}".format(
+            len(filenames), prefix, directory))
+    with open(filenames[0]) as f:
+        lines = f.read().splitlines()
+    return [lines[0]] + sorted(lines[1:])
+
+
+class EngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.data_file = os.path.join(self.directory, "data.csv")
+        write_data_file(self.data_file)
+
+    def run_script(self, server, directory, script, *args):
+        """
+        Run a script of the repository from `directory`, where it finds its
+        logging configuration and writes its result files.
+        """
+        os.makedirs(directory)
+        for config in ("logging_config.json",
+                       "logging_rollback_config.json"):
+            shutil.copy(os.path.join(REPO, config), directory)
+        command = [sys.executable, os.path.join(REPO, script),
+                   "-u", server.url, "-i", "id", "-s", "secret"]
+        process = subprocess.run(command + list(args), cwd=directory,
+                                 stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT,
+                                 universal_newlines=True, timeout=120)
+        self.assertEqual(process.returncode, 0, process.stdout)
+
+    def run_engine(self, engine):
+        """
+        Import the data file with the duplicates updated, then roll back
+        the records created, with the engine given.
+
+        Returns:
+            A dict with the lines of the result files, and the calls
+            received by the server
+        """
+        server = CaptureServer()
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        directory = os.path.join(self.directory, engine)
+        self.run_script(server, directory, "dataload.py", "-E", engine,
+                        "-w", "4", "-r", "100", "-b", "10",
+                        "--delta-migration", self.data_file)
+        results = {prefix: read_results(directory, prefix) for prefix in
+                   ("success", "fail", "update_success", "update_fail")}
+        created = dict(server.uuids)
+
+        success_file = glob.glob(os.path.join(directory, "success_*.csv"))[0]
+        self.run_script(server, os.path.join(directory, "rollback"),
+                        "rollback.py", "-E", engine, "-w", "4", "-r", "100",
+                        success_file)
+        for prefix in ("rollback_success", "rollback_fail"):
+            results[prefix] = read_results(
+                os.path.join(directory, "rollback"), prefix)
+
+        results["created"] = created
+        results["calls"] = sorted(server.calls)
+        results["updates"] = sorted(server.updates, key=json.dumps)
+        results["remaining"] = server.uuids
+        return results
+
+    def test_engines(self):
+        threads = self.run_engine("threads")
+        unique = RECORDS - DUPLICATES
+
+        self.assertEqual(len(threads["created"]), unique)
+        self.assertEqual(len(threads["success"]) - 1, unique)
+        self.assertEqual(len(threads["fail"]) - 1, 0)
+        # An update and a replace of the clients plural per duplicate.
+        self.assertEqual(len(threads["update_success"]) - 1, DUPLICATES)
+        self.assertEqual(len(threads["update_fail"]) - 1, 0)
+        self.assertEqual(len(threads["updates"]), 2 * DUPLICATES)
+        self.assertEqual(len(threads["rollback_success"]) - 1, unique)
+        self.assertEqual(len(threads["rollback_fail"]) - 1, 0)
+        self.assertEqual(threads["remaining"], {})
+
+        asyncio = self.run_engine("asyncio")
+        self.assertEqual(asyncio, threads)
+
+
+if __name__ == "__main__":
+    unittest.main()
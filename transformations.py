@@ -1,9 +1,72 @@
-import time
+import calendar
+import datetime
 import json
 import logging
+import re
+
+from utils.utils import RawJson
 
 logger = logging.getLogger(__file__)
 
+# Date formats of the legacy system(s), in the strptime() syntax. The formats
+# are tried in the order of the dates successfully parsed with each one.
+DATE_FORMATS = (
+    "%m/%d/%Y",
+)
+
+
+def column_transformation(func):
+    """
+    Decorator marking a transformation that receives the whole column of
+    values of a batch and returns the list of transformed values, instead of
+    being called once per value. Transformations without it are applied to
+    each value.
+    """
+    func.column_transformation = True
+    return func
+
+
+class ValueTable(dict):
+    """
+    Table of the normalized values of a categorical column, indexed by the
+    lowercase value. A value missing from the table is normalized by the
+    `default` function.
+    """
+    def __init__(self, values, default):
+        super().__init__(values)
+        self.default = default
+
+    def __missing__(self, key):
+        return self.default(key)
+
+    def transform_column(self, values):
+        return list(map(self.__getitem__, map(str.lower, values)))
+
+
+def default_boolean(value):
+    return None
+
+
+def default_gender(value):
+    if value.strip():
+        return "not specified"
+    return None
+
+
+BOOLEANS = ValueTable({
+    "true": True, "t": True, "1": True,
+    "false": False, "f": False, "0": False
+}, default_boolean)
+
+GENDERS = ValueTable({
+    "male": "male", "m": "male",
+    "female": "female", "f": "female",
+    "other": "other", "o": "other",
+    "not specified": "not specified", "ns": "not specified",
+    "na": "not specified", "n/a": "not specified"
+}, default_gender)
+
+
 def transform_password(value):
     """
     Transform a password hash into an object that specifies the type of hashing
@@ -20,26 +83,150 @@ def transform_password(value):
     return formated_json
 
 
-def transform_date(value):
+def transform_password_raw(value):
     """
-    Date formats are required in the format of "%Y-%m-%d %H:%M:%S" (UTC). This
-    function transforms dates from the legacy system(s) into this format.
+    Same as transform_password() but a JSON password object is kept as the
+    text of the CSV, sent as it is in the API call.
     """
     if not value:
         return None
 
-    input_formats = (
-        "%m/%d/%Y",
-    )
+    try:
+        json.loads(value)
+    except ValueError:
+        return value
+    return RawJson(value)
+
+
+class DateParser(object):
+    """
+    Parses dates in a list of formats and returns them in the format of
+    "%Y-%m-%d %H:%M:%S" (UTC). The formats use the strptime() syntax, but each
+    one is compiled once into a regular expression matching the same values,
+    which is much faster than trying time.strptime() with each format. Dates
+    with a timezone (%z) are converted to UTC, the others are assumed to be in
+    UTC already.
+
+    The formats are kept ordered by the number of dates parsed with each one,
+    so that the most common format is tried first.
+
+    Args:
+        formats - List of date formats
+    """
+    MONTHS = "|".join(calendar.month_name[1:] + calendar.month_abbr[1:])
+    DIRECTIVES = {
+        'Y': r"(?P<Y>\d\d\d\d)",
+        'y': r"(?P<y>\d\d)",
+        'm': r"(?P<m>1[0-2]|0[1-9]|[1-9])",
+        'b': r"(?P<b>{})".format(MONTHS),
+        'B': r"(?P<B>{})".format(MONTHS),
+        'd': r"(?P<d>3[01]|[12]\d|0[1-9]|[1-9]| [1-9])",
+        'H': r"(?P<H>2[0-3]|[0-1]\d|\d)",
+        'I': r"(?P<I>1[0-2]|0[1-9]|[1-9])",
+        'p': r"(?P<p>AM|PM)",
+        'M': r"(?P<M>[0-5]\d|\d)",
+        'S': r"(?P<S>6[0-1]|[0-5]\d|\d)",
+        'f': r"(?P<f>\d{1,6})",
+        'z': r"(?P<z>Z|[+-]\d\d:?[0-5]\d)",
+        '%': "%"
+    }
+    MONTH_NUMBERS = {name.lower(): number
+                     for names in (calendar.month_name, calendar.month_abbr)
+                     for number, name in enumerate(names) if number}
+
+    def __init__(self, formats):
+        self.formats = [[0, date_format, self.compile(date_format)]
+                        for date_format in formats]
+
+    @classmethod
+    def compile(cls, date_format):
+        """
+        Compile a strptime() format into a regular expression.
+        """
+        pattern = ""
+        for part in re.split(r"(%.)", date_format):
+            if part.startswith("%") and len(part) == 2:
+                if part[1] not in cls.DIRECTIVES:
+                    raise ValueError("Unsupported directive {} in date format "
+                                     "{}".format(part, date_format))
+                pattern += cls.DIRECTIVES[part[1]]
+            else:
+                # Like strptime(), whitespace matches any whitespace.
+                pattern += r"\s+".join(re.escape(text)
+                                       for text in re.split(r"\s+", part))
+        return re.compile(pattern, re.IGNORECASE)
+
+    def parse(self, value):
+        for i, entry in enumerate(self.formats):
+            match = entry[2].fullmatch(value)
+            if match is None:
+                continue
+            try:
+                date = self.to_utc(match.groupdict())
+            except ValueError:
+                continue
+            entry[0] += 1
+            # Move the format before the previous one once it parsed more
+            # dates, so the formats stay ordered by use.
+            if i and entry[0] > self.formats[i - 1][0]:
+                self.formats[i - 1], self.formats[i] = (entry,
+                                                        self.formats[i - 1])
+            return date.strftime("%Y-%m-%d %H:%M:%S")
+        raise ValueError("Could not parse date [{}]".format(value))
+
+    def to_utc(self, fields):
+        """
+        Build the date from the fields matched by a format. Raises ValueError
+        if the date does not exist.
+        """
+        if fields.get('Y'):
+            year = int(fields['Y'])
+        elif fields.get('y'):
+            # Same pivot year as strptime()
+            year = int(fields['y'])
+            year += 1900 if year >= 69 else 2000
+        else:
+            year = 1900
 
-    for try_format in input_formats:
-        try:
-            parsed_time = time.strptime(value.upper(), try_format)
-            return time.strftime("%Y-%m-%d %H:%M:%S", parsed_time)
-        except ValueError:
-            pass
+        month_name = fields.get('b') or fields.get('B')
+        if month_name:
+            month = self.MONTH_NUMBERS[month_name.lower()]
+        else:
+            month = int(fields.get('m') or 1)
 
-    raise ValueError("Could not parse date [{}]".format(value))
+        if fields.get('I'):
+            hour = int(fields['I']) % 12
+            if (fields.get('p') or "").upper() == "PM":
+                hour += 12
+        else:
+            hour = int(fields.get('H') or 0)
+
+        date = datetime.datetime(year, month, int(fields.get('d') or 1), hour,
+                                 int(fields.get('M') or 0),
+                                 min(int(fields.get('S') or 0), 59))
+
+        offset = fields.get('z')
+        if offset and offset.upper() != "Z":
+            offset = offset.replace(":", "")
+            minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+            if offset[0] == "-":
+                minutes = -minutes
+            date -= datetime.timedelta(minutes=minutes)
+        return date
+
+
+DATE_PARSER = DateParser(DATE_FORMATS)
+
+
+def transform_date(value):
+    """
+    Date formats are required in the format of "%Y-%m-%d %H:%M:%S" (UTC). This
+    function transforms dates from the legacy system(s) into this format. The
+    formats of the legacy dates are listed in DATE_FORMATS.
+    """
+    if not value:
+        return None
+    return DATE_PARSER.parse(value)
 
 
 def transform_plural(value):
@@ -52,34 +239,47 @@ def transform_plural(value):
     return json.loads(value)
 
 
+def transform_plural_raw(value):
+    """
+    Validate the plural data represented in the CSV as a JSON string, keeping
+    the text of the CSV to be sent as it is in the API call.
+    """
+    if not value:
+        return []
+    json.loads(value)
+    return RawJson(value)
+
+
 def transform_boolean(value):
     """
     Transform boolean values that are blank into NULL so that they are not
     imported as empty strings.
     """
-    if value.lower() in ("true", "t", "1"):
-        return True
-    elif value.lower() in ("false", "f", "0"):
-        return False
-    else:
-        return None
+    return BOOLEANS[value.lower()]
+
+
+@column_transformation
+def transform_boolean_column(values):
+    """
+    Column version of transform_boolean().
+    """
+    return BOOLEANS.transform_column(values)
+
 
 def transform_gender(value):
     """
     Transform any gender value into a normalized value.
     """
-    if value.lower() in ("male", "m"):
-        return "male"
-    elif value.lower() in ("female", "f"):
-        return "female"
-    elif value.lower() in ("other", "o"):
-        return "other"
-    elif value.lower() in ("not specified", "ns", "na", "n/a"):
-        return "not specified"
-    elif value.strip():
-        return "not specified"
-    else:
-        return None
+    return GENDERS[value.lower()]
+
+
+@column_transformation
+def transform_gender_column(values):
+    """
+    Column version of transform_gender().
+    """
+    return GENDERS.transform_column(values)
+
 
 def transform_number(value):
     """
@@ -88,3 +288,11 @@ def transform_number(value):
     if not value:
         return None
     return float(value)
+
+
+@column_transformation
+def transform_number_column(values):
+    """
+    Column version of transform_number().
+    """
+    return [float(value) if value else None for value in values]
@@ -0,0 +1,238 @@
+import asyncio
+import gzip
+import logging
+import ssl
+from urllib.parse import urlencode, urlsplit
+
+import requests
+from janrain.capture.api import (api_encode, generate_signature,
+                                 raise_api_exceptions)
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from utils.session_api import log_connection_stats
+
+logger = logging.getLogger(__name__)
+
+
+class StaleConnection(Exception):
+    """
+    The server closed a kept-alive connection before sending a response.
+    """
+
+
+class AsyncApi(object):
+    """
+    Make the API calls of a janrain.capture.Api instance from an asyncio event
+    loop. The parameters are encoded and signed by the janrain.capture
+    functions, and the responses raise the same ApiResponseError and
+    requests.HTTPError exceptions. The connections are kept alive and reused
+    by the next calls, up to `pool_size` idle connections.
+
+    Args:
+        api       - A janrain.capture.Api instance
+        pool_size - Number of idle connections kept alive to the API
+        timeout   - Seconds to wait for the connection, the request and its
+                    response, requests.Timeout is raised after
+    """
+    def __init__(self, api, pool_size=10, timeout=None):
+        self.api = api
+        self.timeout = timeout
+        url = urlsplit(api.api_url)
+        self.url = "{}://{}".format(url.scheme, url.netloc)
+        self.netloc = url.netloc
+        self.host = url.hostname
+        if url.scheme == "https":
+            self.port = url.port or 443
+            self.ssl = ssl.create_default_context()
+        else:
+            self.port = url.port or 80
+            self.ssl = None
+        self.path = url.path.rstrip("/")
+        self.pool_size = pool_size
+        self._connections = []
+        self.requests = 0
+        self.opened = 0
+        self._logged = (0, 0)
+
+    async def call(self, api_call, **kwargs):
+        """
+        Same as janrain.capture.Api.call(), in a coroutine.
+        """
+        # Encode values for the API (JSON, bools, nulls)
+        params = self.api.defaults.copy()
+        for key, value in kwargs.items():
+            if value is not None:
+                params[key] = value
+        params = {k: api_encode(v) for k, v in params.items()}
+
+        if api_call[0] != "/":
+            api_call = "/" + api_call
+
+        if self.api.sign_requests:
+            headers, params = generate_signature(api_call, params)
+        else:
+            headers = {}
+        headers['User-Agent'] = self.api.user_agent
+        if self.api.compress:
+            headers['Accept-Encoding'] = 'gzip'
+
+        r = await self.post(self.path + api_call, headers, params)
+
+        try:
+            raise_api_exceptions(r.json())
+            if r.status_code not in (200, 400, 401):
+                # /oauth/token returns 400 or 401
+                r.raise_for_status()
+            return r.json()
+        except ValueError:
+            # The response was not valid JSON (empty body, 5xx errors, etc.)
+            r.raise_for_status()
+
+    async def post(self, path, headers, params):
+        """
+        Send a form POST request, returning a requests.Response instance.
+        """
+        body = urlencode(params).encode("utf-8")
+        lines = [
+            "POST {} HTTP/1.1".format(path),
+            "Host: {}".format(self.netloc),
+            "Accept: */*",
+            "Connection: keep-alive",
+            "Content-Type: application/x-www-form-urlencoded",
+            "Content-Length: {}".format(len(body))
+        ]
+        lines.extend("{}: {}".format(k, v) for k, v in headers.items())
+        request = "\r\n".join(lines).encode("latin-1") + b"\r\n\r\n" + body
+
+        # The exchange is cancelled after the timeout, closing the
+        # connection, so that a stalled server does not hold the task.
+        try:
+            return await asyncio.wait_for(self._send(path, request),
+                                          self.timeout)
+        except asyncio.TimeoutError:
+            raise requests.Timeout("Request to {} timed out after {}s".format(
+                self.url + path, self.timeout))
+
+    async def _send(self, path, request):
+        """
+        Send an encoded request, on an idle connection if there is one.
+        """
+        while True:
+            reader, writer, reused = await self._connect()
+            try:
+                writer.write(request)
+                await writer.drain()
+                response, keep_alive = await self._read_response(reader)
+            except (StaleConnection, ConnectionError,
+                    asyncio.IncompleteReadError) as error:
+                writer.close()
+                # A kept-alive connection may have been closed by the server
+                # while idle, the request is sent again on a new connection.
+                if reused and isinstance(error, (StaleConnection,
+                                                 ConnectionResetError,
+                                                 BrokenPipeError)):
+                    continue
+                raise requests.ConnectionError(
+                    "Connection to {} failed: {}".format(self.url, error))
+            except BaseException:
+                writer.close()
+                raise
+            self.requests += 1
+            if keep_alive and len(self._connections) < self.pool_size:
+                self._connections.append((reader, writer))
+            else:
+                writer.close()
+            response.url = self.url + path
+            return response
+
+    async def _connect(self):
+        """
+        Returns an idle connection, or a new one if there is none.
+        """
+        while self._connections:
+            reader, writer = self._connections.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        try:
+            reader, writer = await asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl)
+        except OSError as error:
+            raise requests.ConnectionError(
+                "Connection to {} failed: {}".format(self.url, error))
+        self.opened += 1
+        return reader, writer, False
+
+    async def _read_response(self, reader):
+        """
+        Read an HTTP response, returning a requests.Response instance and
+        whether the connection can be reused.
+        """
+        status_line = await reader.readline()
+        if not status_line:
+            raise StaleConnection()
+        version, status, *reason = status_line.decode("latin-1").split(None,
+                                                                         2)
+        headers = CaseInsensitiveDict()
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip()] = value.strip()
+
+        keep_alive = (version == "HTTP/1.1" and
+                      headers.get("Connection", "").lower() != "close")
+        if headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if not size:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            # Skip the trailers
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            content = b"".join(chunks)
+        elif "Content-Length" in headers:
+            content = await reader.readexactly(int(headers["Content-Length"]))
+        else:
+            content = await reader.read()
+            keep_alive = False
+
+        if headers.get("Content-Encoding", "").lower() == "gzip":
+            content = gzip.decompress(content)
+
+        response = requests.Response()
+        response.status_code = int(status)
+        response.reason = reason[0].strip() if reason else ""
+        response.headers = headers
+        response.encoding = get_encoding_from_headers(headers)
+        response._content = content
+        return response, keep_alive
+
+    async def close(self):
+        """
+        Close the idle connections.
+        """
+        connections, self._connections = self._connections, []
+        for _, writer in connections:
+            writer.close()
+        for _, writer in connections:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    def log_stats(self):
+        """
+        Log the number of requests made and of connections opened since the
+        last call, the requests made on the other connections reused them.
+        """
+        logged_requests, logged_connections = self._logged
+        self._logged = (self.requests, self.opened)
+        log_connection_stats(self.requests - logged_requests,
+                             self.opened - logged_connections,
+                             self.pool_size, self.url)
@@ -1,10 +1,26 @@
 from janrain.capture.cli import ApiArgumentParser
 from janrain.capture import config
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from utils.index import DEFAULT_STRIDE
+from utils.utils import STDIN
 
 import logging
 logger = logging.getLogger(__name__)
 
+def parse_shard(value):
+    """
+    Parse a shard given as I/N, the I-th of N shards, into a tuple (I, N).
+    """
+    try:
+        index, count = (int(number) for number in value.split("/"))
+    except ValueError:
+        raise ArgumentTypeError("invalid shard: {!r}, expected I/N"
+                                .format(value))
+    if not 1 <= index <= count:
+        raise ArgumentTypeError("invalid shard: {!r}, I must be between 1 "
+                                "and N".format(value))
+    return index, count
+
 class SampleGeneratorArgumentParser(ArgumentParser):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -18,6 +34,53 @@ class SampleGeneratorArgumentParser(ArgumentParser):
         self._parsed_args = args
         return self._parsed_args
 
+class IndexArgumentParser(ArgumentParser):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.add_argument('data_file', metavar="DATA_FILE",
+                          help="full path to the data file being indexed")
+        self.add_argument('-n', '--stride', type=int, default=DEFAULT_STRIDE,
+                          help="number of records between index entries\
+                          (default: {})".format(DEFAULT_STRIDE))
+
+    def parse_args(self, args=None, namespace=None):
+        args = super().parse_args(args, namespace)
+        self._parsed_args = args
+        return self._parsed_args
+
+class BenchmarkArgumentParser(ArgumentParser):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.add_argument('benchmark', choices=["batches", "count", "dates",
+                                               "json"],
+                          help="benchmark to run")
+        self.add_argument('data_file', metavar="DATA_FILE",
+                          help="full path to the data file used")
+        self.add_argument('-b', '--batch-size', type=int, default=100,
+                          help="number of records per batch (default: 100)")
+        self.add_argument('-n', '--records', type=int, default=10000,
+                          help="number of records read (default: 10000)")
+
+    def parse_args(self, args=None, namespace=None):
+        args = super().parse_args(args, namespace)
+        self._parsed_args = args
+        return self._parsed_args
+
+class MergeArgumentParser(ArgumentParser):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.add_argument('result_files', metavar="RESULT_FILE", nargs="+",
+                          help="success, fail, retry and update result files\
+                          of the shards of an import")
+        self.add_argument('-O', '--output-dir', default=".",
+                          help="directory where the merged result files are\
+                          written (default: current directory)")
+
+    def parse_args(self, args=None, namespace=None):
+        args = super().parse_args(args, namespace)
+        self._parsed_args = args
+        return self._parsed_args
+
 class DataLoadArgumentParser(ApiArgumentParser):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -25,18 +88,97 @@ class DataLoadArgumentParser(ApiArgumentParser):
                           help="entity type name (default: user)")
         self.add_argument('-b', '--batch-size', type=int, default=100,
                           help="number of records per batch (default: 100)")
+        self.add_argument('-B', '--max-batch-bytes', type=int, default=0,
+                          help="split the batches larger than this number of\
+                          bytes once encoded as JSON (default: 0, no limit)")
         self.add_argument('-a', '--start-at', type=int, default=1,
                           help="record number to start at (default: 1)")
+        self.add_argument('-N', '--shard', type=parse_shard, metavar="I/N",
+                          help="only load the I-th of N shards of the data\
+                          file, made of every N-th batch, with its own result\
+                          files")
         self.add_argument('data_file', metavar="DATA_FILE",
-                          help="full path to the data file being loaded")
+                          help="full path to the data file being loaded, or\
+                          - to read it from the standard input")
         self.add_argument('-w', '--workers', type=int, default=10,
-                          help="number of worker threads (default: 10)")
+                          help="number of worker threads, or of API calls\
+                          made at once with asyncio (default: 10)")
+        self.add_argument('-E', '--engine', choices=["threads", "asyncio"],
+                          default="threads",
+                          help="make the API calls from worker threads or\
+                          from an asyncio event loop, which can make\
+                          hundreds of calls at once (default: threads)")
+        self.add_argument('-S', '--pool-size', type=int, default=0,
+                          help="number of connections kept alive to the API\
+                          and reused by the API calls (default: the number of\
+                          --workers)")
         self.add_argument('-o', '--timeout', type=int, default=10,
                           help="timeout in seconds for API calls (default: 10)")
         self.add_argument('-r', '--rate-limit', type=float, default=4.0,
                           help="max API calls per second (default: 4)")
+        self.add_argument('-z', '--burst', type=int, default=1,
+                          help="max API calls made at once after the workers\
+                          were idle, within the --rate-limit (default: 1)")
+        self.add_argument('-A', '--adaptive', action="store_true",
+                          help="adjust the number of API calls made at once\
+                          up to the number of --workers, increasing it while\
+                          the calls succeed and halving it on errors and slow\
+                          calls")
+        self.add_argument('-L', '--latency-target', type=float, default=0,
+                          help="seconds above which an API call is considered\
+                          slow in --adaptive mode (default: half the\
+                          --timeout)")
+        self.add_argument('-M', '--max-attempts', type=int, default=3,
+                          help="number of attempts of an API call failing with\
+                          a retryable error, before the records are written to\
+                          the retry file (default: 3)")
+        self.add_argument('-D', '--retry-delay', type=float, default=1.0,
+                          help="seconds of backoff before the first retry of an\
+                          API call, doubled at each attempt with a random\
+                          jitter (default: 1)")
+        self.add_argument('-F', '--bisect-failures', action="store_true",
+                          help="split the batches failing as a whole with an\
+                          error that is not retried in halves sent again,\
+                          until the records failing are isolated")
         self.add_argument('-x', '--dry-run', action="store_true",
                           help="process data without making any API calls")
+        self.add_argument('-1', '--single-pass', action="store_true",
+                          help="validate the encoding and count the records\
+                          while loading instead of reading the data file\
+                          beforehand")
+        self.add_argument('-P', '--parse-workers', type=int, default=0,
+                          help="number of processes used to transform the\
+                          records (default: 0, transform in the main\
+                          process)")
+        self.add_argument('-R', '--range-reader', action="store_true",
+                          help="split the data file in byte ranges parsed in\
+                          parallel by the --parse-workers processes (default:\
+                          one per CPU)")
+        self.add_argument('-c', '--cache-size', type=int, default=0,
+                          help="cache the results of the date and plural\
+                          transformations for this number of distinct values\
+                          per column (default: 0, no cache)")
+        self.add_argument('-C', '--compact-batches', action="store_true",
+                          help="keep the batches waiting for a worker in a\
+                          compact form, the records are built by the worker\
+                          making the API call")
+        self.add_argument('-J', '--raw-json', action="store_true",
+                          help="validate the JSON columns but send them as\
+                          the text read from the data file instead of\
+                          decoding and encoding them again")
+        self.add_argument('-f', '--flush-interval', type=float, default=1.0,
+                          help="seconds between two writes of the result logs\
+                          to disk (default: 1)")
+        self.add_argument('-j', '--resume', metavar="JOURNAL",
+                          help="resume an interrupted import from its journal\
+                          file, skipping the batches it completed. The\
+                          batches in flight when it stopped are sent again:\
+                          their records already created fail as duplicates\
+                          and cannot be rolled back")
+        self.add_argument('-I', '--build-index', action="store_true",
+                          help="save a record offset index next to the data\
+                          file while loading, used to seek to the --start-at\
+                          record on later runs")
 
         dm_group = self.add_argument_group(title='Delta Migration Arguments')
         dm_group.add_argument('-m', '--delta-migration', action="store_true",
@@ -61,6 +203,16 @@ class DataLoadArgumentParser(ApiArgumentParser):
             args.client_secret = credentials['client_secret']
             args.apid_uri = credentials['apid_uri']
 
+        if not args.latency_target:
+            args.latency_target = args.timeout / 2
+
+        if args.pool_size <= 0:
+            args.pool_size = args.workers
+
+        # The standard input can only be read once.
+        if args.data_file == STDIN:
+            args.single_pass = True
+
         logger.debug(args.apid_uri)
         self._parsed_args = args
         return self._parsed_args
@@ -73,11 +225,36 @@ class RollbackArgumentParser(ApiArgumentParser):
         self.add_argument('data_file', metavar="DATA_FILE",
                             help="full path to the data file being loaded")
         self.add_argument('-w', '--workers', type=int, default=10,
-                            help="number of worker threads (default: 10)")
+                            help="number of worker threads, or of API calls\
+                            made at once with asyncio (default: 10)")
+        self.add_argument('-E', '--engine', choices=["threads", "asyncio"],
+                            default="threads",
+                            help="make the API calls from worker threads or\
+                            from an asyncio event loop, which can make\
+                            hundreds of calls at once (default: threads)")
+        self.add_argument('-S', '--pool-size', type=int, default=0,
+                            help="number of connections kept alive to the API\
+                            and reused by the API calls (default: the number\
+                            of --workers)")
         self.add_argument('-o', '--timeout', type=int, default=10,
                             help="timeout in seconds for API calls (default: 10)")
         self.add_argument('-r', '--rate-limit', type=float, default=4.0,
                             help="max API calls per second (default: 4)")
+        self.add_argument('-z', '--burst', type=int, default=1,
+                            help="max API calls made at once after the\
+                            workers were idle, within the --rate-limit\
+                            (default: 1)")
+        self.add_argument('-M', '--max-attempts', type=int, default=3,
+                            help="number of attempts of an API call failing\
+                            with a retryable error, before the record is\
+                            logged as failed (default: 3)")
+        self.add_argument('-D', '--retry-delay', type=float, default=1.0,
+                            help="seconds of backoff before the first retry of\
+                            an API call, doubled at each attempt with a random\
+                            jitter (default: 1)")
+        self.add_argument('-f', '--flush-interval', type=float, default=1.0,
+                            help="seconds between two writes of the result\
+                            logs to disk (default: 1)")
         self.add_argument('-x', '--dry-run', action="store_true",
                             help="process data without making any API calls")
 
@@ -95,6 +272,9 @@ class RollbackArgumentParser(ApiArgumentParser):
             args.client_secret = credentials['client_secret']
             args.apid_uri = credentials['apid_uri']
 
+        if args.pool_size <= 0:
+            args.pool_size = args.workers
+
         logger.debug(args.apid_uri)
         self._parsed_args = args
         return self._parsed_args
@@ -0,0 +1,298 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.async_api import AsyncApi
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedExecutor(object):
+    """
+    Thread pool executor limiting the number of tasks submitted and not
+    finished yet. When the limit is reached, submit() blocks until a task
+    finishes and frees a slot, so the tasks are not read faster than the
+    workers process them.
+
+    The futures are not kept once their task is finished, so the tasks and
+    their arguments are released as soon as they are processed. The first
+    uncaught exception of a task is raised by the next submit() or by wait(),
+    and the tasks still waiting for a worker are not run.
+
+    Args:
+        max_workers - Number of worker threads
+        queue_size  - Number of tasks waiting for a worker, on top of the
+                      tasks being processed by the workers
+    """
+    def __init__(self, max_workers, queue_size):
+        self.max_workers = max_workers
+        self.max_pending = max_workers + max(0, int(queue_size))
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.submitted = 0
+        self.pending_total = 0
+        self.pending_max = 0
+        self.stalls = 0
+        self.stall_time = 0
+        self.skipped = 0
+        self.error = None
+        self._start()
+
+    def _start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        if self.skipped:
+            logger.error("{} tasks were not run after the error".format(
+                self.skipped))
+        return False
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Submit a task to the workers, waiting for a free slot if needed.
+
+        Returns:
+            A concurrent.futures.Future instance
+
+        Raises:
+            The uncaught exception of a task finished before
+        """
+        self._raise_error()
+        if not self._slots.acquire(blocking=False):
+            start_time = time.time()
+            self._slots.acquire()
+            with self._lock:
+                self.stalls += 1
+                self.stall_time += time.time() - start_time
+            if self.error is not None:
+                self._slots.release()
+                self._raise_error()
+
+        with self._lock:
+            self.pending += 1
+            self.submitted += 1
+            self.pending_total += self.pending
+            self.pending_max = max(self.pending_max, self.pending)
+        try:
+            future = self._submit(fn, *args, **kwargs)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _submit(self, fn, *args, **kwargs):
+        return self._executor.submit(self._run, fn, args, kwargs)
+
+    def _run(self, fn, args, kwargs):
+        if self._skip():
+            return None
+        return fn(*args, **kwargs)
+
+    def _skip(self):
+        """
+        Tell if a task must not be run because another one failed.
+        """
+        if self.error is None:
+            return False
+        with self._lock:
+            self.skipped += 1
+        return True
+
+    def _release(self, future):
+        with self._lock:
+            self.pending -= 1
+            if (future is not None and not future.cancelled() and
+                    future.exception() is not None and self.error is None):
+                self.error = future.exception()
+                logger.error("Stopping the workers after an uncaught error: "
+                             "{!r}".format(self.error))
+        self._slots.release()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _wait_idle(self):
+        # All the slots are free once the tasks are finished.
+        for _ in range(self.max_pending):
+            self._slots.acquire()
+        for _ in range(self.max_pending):
+            self._slots.release()
+
+    def wait(self):
+        """
+        Wait for the tasks submitted to finish.
+
+        Raises:
+            The first uncaught exception of a task
+        """
+        self._wait_idle()
+        self._raise_error()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def log_stats(self):
+        """
+        Log the number of tasks waiting for a worker and the time the
+        submissions were blocked waiting for a free slot.
+        """
+        if not self.submitted:
+            return
+        logger.info("{} tasks submitted, {:.1f} pending on average (max {} of "
+                    "{}), submissions blocked {} times for {:.1f}s".format(
+                        self.submitted, self.pending_total / self.submitted,
+                        self.pending_max, self.max_pending, self.stalls,
+                        self.stall_time))
+
+
+class AsyncioExecutor(BoundedExecutor):
+    """
+    Same as BoundedExecutor, but the tasks are coroutine functions run by an
+    asyncio event loop in a single thread, `max_workers` of them at once.
+    This allows many more API calls to be made at once than with a thread
+    per call.
+
+    Args:
+        max_workers - Number of tasks run at once
+        queue_size  - Number of tasks waiting to be run, on top of the tasks
+                      being run
+        on_shutdown - Coroutine function run in the event loop once the tasks
+                      are finished, such as closing the connections
+    """
+    def __init__(self, max_workers, queue_size, on_shutdown=None):
+        self._on_shutdown = on_shutdown
+        super().__init__(max_workers, queue_size)
+
+    def _start(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name="asyncio", daemon=True)
+        self._thread.start()
+        self._workers = None
+        # The event loop only keeps weak references to the tasks, which
+        # would be garbage collected while waiting for a response.
+        self._tasks = set()
+
+    def _submit(self, fn, *args, **kwargs):
+        return asyncio.run_coroutine_threadsafe(self._run(fn, args, kwargs),
+                                                self._loop)
+
+    async def _run(self, fn, args, kwargs):
+        if self._workers is None:
+            self._workers = asyncio.Semaphore(self.max_workers)
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            async with self._workers:
+                if self._skip():
+                    return None
+                return await fn(*args, **kwargs)
+        finally:
+            self._tasks.discard(task)
+
+    def shutdown(self, wait=True):
+        if not self._loop.is_running():
+            return
+        if wait:
+            self._wait_idle()
+        if self._on_shutdown is not None:
+            asyncio.run_coroutine_threadsafe(self._on_shutdown(),
+                                             self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+def run_calls(calls, api, limiter, concurrency, retry):
+    """
+    Run a task of the thread engine. The task is a generator yielding the
+    endpoint and the parameters of its API calls, which are made here so
+    that the same task runs with both engines. The result of a call is sent
+    back to the generator, or its error thrown into it once the attempts are
+    exhausted.
+
+    Args:
+        calls       - Generator of (api_call, params) tuples
+        api         - A janrain.capture.Api instance
+        limiter     - A utils.limiter.TokenBucket shared by the workers
+        concurrency - A utils.limiter.AdaptiveConcurrency shared by the
+                      workers
+        retry       - A utils.retry.RetryPolicy shared by the workers
+
+    Returns:
+        The value returned by the generator
+    """
+    def call(api_call, params):
+        with concurrency.call(limiter, retry.error_codes):
+            return api.call(api_call, **params)
+
+    try:
+        request = next(calls)
+        while True:
+            try:
+                result = retry.call(call, *request)
+            except Exception as error:
+                request = calls.throw(error)
+            else:
+                request = calls.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def run_calls_async(calls, api, limiter, concurrency, retry):
+    """
+    Same as run_calls(), for the tasks of the asyncio engine.
+
+    Args:
+        calls       - Generator of (api_call, params) tuples
+        api         - A utils.async_api.AsyncApi instance
+        limiter     - A utils.limiter.TokenBucket shared by the tasks
+        concurrency - A utils.limiter.AdaptiveConcurrency shared by the tasks
+        retry       - A utils.retry.RetryPolicy shared by the tasks
+    """
+    async def call(api_call, params):
+        async with concurrency.call_async(limiter, retry.error_codes):
+            return await api.call(api_call, **params)
+
+    try:
+        request = next(calls)
+        while True:
+            try:
+                result = await retry.call_async(call, *request)
+            except Exception as error:
+                request = calls.throw(error)
+            else:
+                request = calls.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+def create_executor(args, api, queue_size):
+    """
+    Create the executor of the engine selected with the --engine argument.
+
+    Args:
+        args       - Arguments captured from CLI
+        api        - A janrain.capture.Api instance
+        queue_size - Number of tasks waiting for a worker
+
+    Returns:
+        A tuple with the executor, the object making the API calls in its
+        tasks and the function running the tasks: the janrain.capture.Api
+        instance and run_calls() for the threads, or a
+        utils.async_api.AsyncApi instance and run_calls_async() for asyncio.
+    """
+    if args.engine == "asyncio":
+        api = AsyncApi(api, args.pool_size, args.timeout)
+        return AsyncioExecutor(args.workers, queue_size,
+                               on_shutdown=api.close), api, run_calls_async
+    return BoundedExecutor(args.workers, queue_size), api, run_calls
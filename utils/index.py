@@ -0,0 +1,126 @@
+"""
+Record offset index stored next to a data file, used to seek straight to a
+record instead of parsing all the records before it.
+"""
+import json
+import os
+import sys
+from array import array
+
+import logging
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+DEFAULT_STRIDE = 1000
+
+
+class RecordIndex(object):
+    """
+    Sparse index of the byte offsets where the records of a CSV file start.
+    One entry is kept every `stride` records with the byte offset and the
+    physical line number of the record. Offsets are taken from the position
+    of the CSV parser, so records with quoted fields containing newlines are
+    handled correctly.
+
+    The index is only valid for the exact file it was built from, the size
+    and modification time of the data file are stored with it.
+    """
+    def __init__(self, data_file, stride=DEFAULT_STRIDE):
+        self.data_file = data_file
+        self.filename = data_file + INDEX_SUFFIX
+        self.stride = stride
+        self.records = 0
+        self.offsets = array('Q')
+        self.lines = array('Q')
+
+    def add(self, record_number, offset, line_number):
+        """
+        Register the position of a record. Records must be added in order,
+        only one in `stride` is kept.
+
+        Args:
+            record_number - Number of the record, the first after the header
+                            is record 1
+            offset        - Byte offset where the record starts
+            line_number   - Physical line number where the record starts
+        """
+        self.records = record_number
+        if (record_number - 1) % self.stride == 0:
+            self.offsets.append(offset)
+            self.lines.append(line_number)
+
+    def lookup(self, record_number):
+        """
+        Find the closest indexed record at or before the given record.
+
+        Returns:
+            A tuple with the record number, byte offset and line number of
+            the indexed record, or None if there is no entry to seek to.
+        """
+        if not self.offsets or record_number <= 1:
+            return None
+        position = min((record_number - 1) // self.stride,
+                       len(self.offsets) - 1)
+        return (position * self.stride + 1, self.offsets[position],
+                self.lines[position])
+
+    def save(self):
+        stat = os.stat(self.data_file)
+        metadata = {
+            'version': INDEX_VERSION,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'stride': self.stride,
+            'records': self.records,
+            'entries': len(self.offsets),
+            'byteorder': sys.byteorder
+        }
+        with open(self.filename, "wb") as f:
+            f.write(json.dumps(metadata).encode("utf-8") + b"\n")
+            self.offsets.tofile(f)
+            self.lines.tofile(f)
+        logger.info("Record index saved to {}".format(self.filename))
+
+    @classmethod
+    def load(cls, data_file):
+        """
+        Load the index of a data file.
+
+        Returns:
+            A RecordIndex instance or None if the index does not exist or
+            does not match the current data file.
+        """
+        filename = data_file + INDEX_SUFFIX
+        if not os.path.isfile(filename):
+            return None
+
+        stat = os.stat(data_file)
+        with open(filename, "rb") as f:
+            try:
+                metadata = json.loads(f.readline().decode("utf-8"))
+            except ValueError:
+                logger.warning("Ignoring invalid record index {}"
+                               .format(filename))
+                return None
+            if (metadata.get('version') != INDEX_VERSION or
+                    metadata['size'] != stat.st_size or
+                    metadata['mtime'] != stat.st_mtime_ns):
+                logger.warning("Ignoring outdated record index {}"
+                               .format(filename))
+                return None
+
+            index = cls(data_file, metadata['stride'])
+            index.records = metadata['records']
+            try:
+                index.offsets.fromfile(f, metadata['entries'])
+                index.lines.fromfile(f, metadata['entries'])
+            except EOFError:
+                logger.warning("Ignoring truncated record index {}"
+                               .format(filename))
+                return None
+
+        if metadata['byteorder'] != sys.byteorder:
+            index.offsets.byteswap()
+            index.lines.byteswap()
+        return index
@@ -0,0 +1,191 @@
+"""
+Journal of the batches completed by an import, used to resume an import that
+was interrupted without loading the completed batches again.
+"""
+import json
+import os
+import threading
+
+from utils.reader import next_shard_batch
+
+import logging
+logger = logging.getLogger(__name__)
+
+JOURNAL_VERSION = 1
+# Number of entries appended between two compactions of the journal.
+COMPACT_INTERVAL = 1000
+
+
+class JournalError(Exception):
+    pass
+
+
+class BatchJournal(object):
+    """
+    Append-only journal of the batches completed by the workers, with their
+    outcome. The batches complete out of order, so the journal keeps a low
+    watermark: the highest batch number such that all the batches up to it
+    are completed. Every `compact_interval` entries, the journal is rewritten
+    with the watermark and only the entries of the batches completed above
+    it, so that loading it does not depend on the length of the import.
+
+    The journal also keeps a checkpoint: the number and the last record of
+    the highest batch up to the watermark which ends on a multiple of the
+    batch size. A resumed import reads the data file from the record after
+    the checkpoint, the batches being split at the same records, instead of
+    reading the batches completed before. Without --max-batch-bytes it is
+    the batch of the watermark, unless it is a shorter last batch.
+
+    The first line of the journal is a JSON object with the parameters of the
+    import, which must be the same for the batch numbers to match when
+    resuming, the watermark and the checkpoint. Each following line is a JSON
+    list with the batch number, the first and last line and the outcome of a
+    batch.
+
+    The entries are flushed when they are added, like the result files, so
+    they are kept if the import is stopped or crashes, but not if the system
+    crashes. Only the compacted journal is synced to the disk.
+
+    Args:
+        filename         - Path of the journal
+        params           - Dict with the parameters of the import
+        batch_size       - Number of records per batch, before the batches
+                           are split with --max-batch-bytes
+        update_file      - Path of the file with the records to update of a
+                           delta migration
+        shard            - Tuple with the number of the shard and the number
+                           of shards loaded, or None
+        compact_interval - Entries appended between two compactions
+    """
+    def __init__(self, filename, params, batch_size, update_file=None,
+                 shard=None, compact_interval=COMPACT_INTERVAL):
+        self.filename = filename
+        self.params = params
+        self.batch_size = batch_size
+        self.update_file = update_file
+        self.shard = shard
+        self.compact_interval = compact_interval
+        self.watermark = 0
+        # Number and last record of the batch to resume after, or None
+        self.checkpoint = None
+        # Entries of the batches completed above the watermark
+        self.entries = {}
+        self.appended = 0
+        self._lock = threading.Lock()
+        self._file = None
+
+    def open(self):
+        """
+        Write the journal with the batches completed so far and open it to
+        append the next ones.
+        """
+        with self._lock:
+            self._compact()
+
+    def load(self, filename):
+        """
+        Load the batches completed by a previous import from its journal.
+
+        Returns:
+            The header of the journal, with the 'update_file' of the import
+
+        Raises:
+            JournalError if the journal can't be read or the import had
+            different parameters
+        """
+        try:
+            with open(filename, "r") as f:
+                header = json.loads(f.readline())
+                entries = []
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # The last line may be incomplete after a crash.
+                        logger.warning("Ignoring an incomplete entry of the "
+                                       "journal {}".format(filename))
+        except (OSError, ValueError) as error:
+            raise JournalError("Can't read the journal {}: {}".format(
+                filename, error))
+
+        if header.get('version') != JOURNAL_VERSION:
+            raise JournalError("Unsupported journal version in {}".format(
+                filename))
+        for key, value in self.params.items():
+            if header['params'].get(key) != value:
+                raise JournalError(
+                    "The journal {} is for an import with {}={!r}, the "
+                    "batches can't be matched with {}={!r}".format(
+                        filename, key, header['params'].get(key), key, value))
+
+        self.watermark = header['watermark']
+        self.checkpoint = header.get('checkpoint')
+        for entry in entries:
+            if entry[0] > self.watermark:
+                self.entries[entry[0]] = entry
+        self._advance()
+        return header
+
+    def is_completed(self, batch_id):
+        return batch_id <= self.watermark or batch_id in self.entries
+
+    def add(self, batch, outcome):
+        """
+        Record a batch as completed. The entry is flushed before returning,
+        but not synced, so the results of the batch must be written before.
+
+        Args:
+            batch   - A utils.reader.CsvBatch instance
+            outcome - Word describing the outcome of the batch
+        """
+        entry = [batch.id, batch.start_line, batch.end_line, outcome]
+        with self._lock:
+            self.entries[batch.id] = entry
+            self._advance()
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            self.appended += 1
+            if self.appended >= self.compact_interval:
+                self._compact()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._compact()
+                self._file.close()
+                self._file = None
+
+    def _advance(self):
+        while next_shard_batch(self.watermark, self.shard) in self.entries:
+            self.watermark = next_shard_batch(self.watermark, self.shard)
+            entry = self.entries.pop(self.watermark)
+            # The line of the record is the record number plus one.
+            last_record = entry[2] - 1
+            if last_record % self.batch_size == 0:
+                self.checkpoint = [entry[0], last_record]
+
+    def _compact(self):
+        """
+        Rewrite the journal with the watermark and the entries above it. The
+        new journal replaces the old one only once it is written, so a crash
+        leaves one of them complete.
+        """
+        header = {
+            'version': JOURNAL_VERSION,
+            'params': self.params,
+            'update_file': self.update_file,
+            'watermark': self.watermark,
+            'checkpoint': self.checkpoint
+        }
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            f.write(json.dumps(header) + "\n")
+            for batch_id in sorted(self.entries):
+                f.write(json.dumps(self.entries[batch_id]) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self._file is not None:
+            self._file.close()
+        os.replace(tmp_filename, self.filename)
+        self._file = open(self.filename, "a")
+        self.appended = 0
@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import requests
+from janrain.capture import ApiResponseError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    Rate limiter shared by the worker threads. Each API call takes a token
+    from the bucket, which is refilled at the given rate up to the burst size.
+    A thread taking a token from an empty bucket sleeps until the token is
+    refilled, the tokens being reserved in the order they are requested.
+
+    Args:
+        rate  - Tokens refilled per second, no limit if 0
+        burst - Maximum number of tokens in the bucket, which is full at start
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self._lock = threading.Lock()
+        self._updated = time.monotonic()
+        self.acquired = 0
+        self.first_time = None
+        self.last_time = None
+        self.wait_time = 0
+
+    def acquire(self, tokens=1):
+        """
+        Take tokens from the bucket, sleeping until they are available.
+        """
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+        """
+        Same as acquire(), for the tasks of an asyncio event loop.
+        """
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _reserve(self, tokens):
+        """
+        Take tokens from the bucket, returning the number of seconds to wait
+        until they are refilled.
+        """
+        wait = 0
+        with self._lock:
+            now = time.monotonic()
+            if self.rate > 0:
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self._updated) * self.rate)
+                self._updated = now
+                self.tokens -= tokens
+                if self.tokens < 0:
+                    wait = -self.tokens / self.rate
+            self.acquired += tokens
+            if self.first_time is None:
+                self.first_time = now
+            self.last_time = now + wait
+            self.wait_time += wait
+        return wait
+
+    def achieved_rate(self):
+        """
+        Returns the number of tokens taken per second, from the first one to
+        the last one.
+        """
+        if not self.acquired:
+            return 0
+        elapsed = self.last_time - self.first_time
+        if self.rate > 0:
+            # Time to refill the last token
+            elapsed += 1 / self.rate
+        if elapsed <= 0:
+            return 0
+        return self.acquired / elapsed
+
+    def log_stats(self):
+        """
+        Log the number of API calls made and the rate achieved.
+        """
+        if not self.acquired:
+            return
+        logger.info("{} API calls at {:.2f} calls per second (limit: {}, "
+                    "burst: {}), the workers waited {:.1f}s in total".format(
+                        self.acquired, self.achieved_rate(),
+                        self.rate or "none", self.burst, self.wait_time))
+
+
+class AdaptiveConcurrency(object):
+    """
+    Limit the number of API calls made at once by the worker threads. In
+    adaptive mode, the limit is adjusted with additive increase and
+    multiplicative decrease (AIMD): it grows by one after a limit's worth of
+    healthy calls, and is multiplied by the decrease factor when a call
+    fails with a congestion error or is slower than the latency target. The
+    calls started before a decrease do not decrease the limit again.
+
+    Args:
+        max_limit      - Maximum number of calls made at once, which is the
+                         fixed limit when not in adaptive mode
+        latency_target - Seconds above which a call is considered congested
+        adaptive       - Set to True to adjust the limit, starting at half
+                         the maximum
+        decrease       - Factor applied to the limit on congestion
+    """
+    def __init__(self, max_limit, latency_target, adaptive=True,
+                 decrease=0.5):
+        self.max_limit = max(1, max_limit)
+        self.latency_target = latency_target
+        self.adaptive = adaptive
+        self.decrease = decrease
+        if adaptive:
+            self.limit = max(1, self.max_limit // 2)
+        else:
+            self.limit = self.max_limit
+        self.active = 0
+        self.increases = 0
+        self.decreases = 0
+        self.min_reached = self.max_reached = int(self.limit)
+        self._condition = threading.Condition()
+        # Futures of the asyncio tasks waiting for a slot
+        self._waiters = []
+        self._start_time = time.monotonic()
+        self._decreased_at = self._start_time
+        self._changed_at = self._start_time
+        self._limit_time = 0
+
+    def acquire(self):
+        """
+        Wait until the number of calls made at once is under the limit.
+        """
+        with self._condition:
+            while self.active >= int(self.limit):
+                self._condition.wait()
+            self.active += 1
+
+    async def acquire_async(self):
+        """
+        Same as acquire(), for the tasks of an asyncio event loop.
+        """
+        while True:
+            with self._condition:
+                if self.active < int(self.limit):
+                    self.active += 1
+                    return
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+            await waiter
+
+    def release(self, start_time, congested=False):
+        """
+        Release the slot of a call and adjust the limit from its outcome.
+
+        Args:
+            start_time - Value of time.monotonic() when the call was made
+            congested  - Set to True if the call failed with an error
+                         showing that the API is overloaded
+        """
+        now = time.monotonic()
+        latency = now - start_time
+        with self._condition:
+            self.active -= 1
+            if self.adaptive:
+                if congested or latency > self.latency_target:
+                    if start_time >= self._decreased_at:
+                        self._decreased_at = now
+                        self._set_limit(
+                            max(1, self.limit * self.decrease), now,
+                            "error" if congested else
+                            "latency {:.1f}s".format(latency))
+                elif self.limit < self.max_limit:
+                    self._set_limit(
+                        min(self.max_limit, self.limit + 1 / self.limit),
+                        now, "healthy calls")
+            self._condition.notify_all()
+            waiters, self._waiters = self._waiters, []
+        # The asyncio tasks release their slot from the event loop.
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @contextmanager
+    def call(self, limiter, error_codes):
+        """
+        Context manager around an API call, holding a slot and a token of the
+        rate limiter. The API errors with the codes listed in `error_codes`,
+        the timeouts and the connection errors are congestion errors.
+
+        Args:
+            limiter     - A TokenBucket instance
+            error_codes - Dict of the 'api' and 'http' error codes
+        """
+        self.acquire()
+        limiter.acquire()
+        start_time = time.monotonic()
+        try:
+            yield
+        except Exception as error:
+            self.release(start_time, is_congestion_error(error, error_codes))
+            raise
+        self.release(start_time)
+
+    @asynccontextmanager
+    async def call_async(self, limiter, error_codes):
+        """
+        Same as call(), for the tasks of an asyncio event loop.
+        """
+        await self.acquire_async()
+        await limiter.acquire_async()
+        start_time = time.monotonic()
+        try:
+            yield
+        except Exception as error:
+            self.release(start_time, is_congestion_error(error, error_codes))
+            raise
+        self.release(start_time)
+
+    def _set_limit(self, limit, now, reason):
+        previous = int(self.limit)
+        self.limit = limit
+        if int(limit) == previous:
+            return
+        if int(limit) > previous:
+            self.increases += 1
+        else:
+            self.decreases += 1
+        self._limit_time += previous * (now - self._changed_at)
+        self._changed_at = now
+        self.min_reached = min(self.min_reached, int(limit))
+        self.max_reached = max(self.max_reached, int(limit))
+        logger.info("Concurrency limit {} -> {} after {:.1f}s ({})".format(
+            previous, int(limit), now - self._start_time, reason))
+
+    def log_stats(self):
+        """
+        Log the range and the average over time of the concurrency limit.
+        """
+        if not self.adaptive:
+            return
+        now = time.monotonic()
+        elapsed = now - self._start_time
+        limit_time = self._limit_time + int(self.limit) * (
+            now - self._changed_at)
+        logger.info("Concurrency limit between {} and {} (max: {}), {:.1f} "
+                    "on average, {} increases and {} decreases".format(
+                        self.min_reached, self.max_reached, self.max_limit,
+                        limit_time / elapsed if elapsed else self.limit,
+                        self.increases, self.decreases))
+
+
+def is_congestion_error(error, error_codes):
+    """
+    Tell if an exception raised by an API call shows that the API is
+    overloaded.
+    """
+    if isinstance(error, ApiResponseError):
+        return error.code in error_codes['api']
+    elif isinstance(error, requests.HTTPError):
+        return error.response.status_code in error_codes['http']
+    return isinstance(error, requests.RequestException)
@@ -0,0 +1,301 @@
+"""
+CSV batch reader parsing byte ranges of the data file in parallel, through a
+memory map of the file shared by a pool of processes.
+"""
+import csv
+import io
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.reader import (CsvBatchReader, LineBuffer, build_records,
+                          count_shard_records, get_cache_stats, in_shard)
+
+import logging
+logger = logging.getLogger(__name__)
+
+RANGE_SIZE = 8 * 1024 * 1024
+
+# Memory map, RecordBuilder and options of the pool processes, set once by
+# init_range_process().
+_range_process = {}
+
+
+def init_range_process(csv_file, builder, delimiter, compact=False):
+    f = open(csv_file, "rb")
+    _range_process.update({
+        'file': f,
+        'data': mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ),
+        'builder': builder,
+        'delimiter': delimiter,
+        'compact': compact
+    })
+
+
+def count_range_quotes(start, end):
+    """
+    Count the quote characters in a byte range of the data file.
+    """
+    return _range_process['data'][start:end].count(b'"')
+
+
+def count_range_records(start, end):
+    """
+    Count the records and the lines in a byte range of the data file. The
+    range must start at the beginning of a record: newlines inside quoted
+    fields are not counted as records.
+
+    Returns:
+        A tuple with the number of records and the number of newlines.
+    """
+    data = _range_process['data'][start:end]
+    # Splitting on quotes, the even parts are outside of the quoted fields.
+    parts = data.split(b'"')
+    records = sum(part.count(b"\n") for part in parts[0::2])
+    if data and not data.endswith(b"\n"):
+        records += 1
+    return records, data.count(b"\n")
+
+
+def parse_range(start, end, first_record, first_line, expected_records,
+                start_at, batch_size, shard=None, read_from=None):
+    """
+    Parse and transform the records of a byte range of the data file.
+
+    Args:
+        start            - Offset of the first byte of the range
+        end              - Offset after the last byte of the range
+        first_record     - Number of the first record of the range
+        first_line       - Physical line number where the range starts
+        expected_records - Number of records counted in the range
+        start_at         - First record of the import, the batches are
+                           numbered from the one of this record
+        batch_size       - Number of records per batch
+        shard            - The records of the batches of other shards are
+                           skipped
+        read_from        - Records before this one are skipped, `start_at`
+                           by default
+
+    Returns:
+        A list of tuples with the batch group, the line number of the first
+        record, the rows and the records of each group found in the range.
+        With compact batches the rows are replaced by the raw text of the
+        records and the records by their transformed values. The first and
+        last groups may continue in the adjacent ranges. The list is returned
+        with the process id and its cache stats.
+    """
+    data = _range_process['data'][start:end]
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError as error:
+        line = first_line + data.count(b"\n", 0, error.start)
+        logger.error("Line {}: {}".format(line, str(error)))
+        raise error
+
+    compact = _range_process['compact']
+    lines = io.StringIO(text, newline="")
+    if compact:
+        lines = LineBuffer(lines)
+    reader = csv.reader(lines, delimiter=_range_process['delimiter'])
+    groups = []
+    group_rows = None
+    first_group = (start_at - 1) // batch_size
+    if read_from is None:
+        read_from = start_at
+    record_number = first_record - 1
+    for record_number, row in enumerate(reader, first_record):
+        raw_record = lines.pop() if compact else None
+        if record_number < read_from:
+            continue
+        group = (record_number - 1) // batch_size
+        if not in_shard(group - first_group + 1, shard):
+            continue
+        if group_rows is None or groups[-1][0] != group:
+            group_rows = []
+            group_lines = []
+            groups.append((group, record_number + 1, group_rows, group_lines))
+        group_rows.append(row)
+        if compact:
+            group_lines.append(raw_record)
+
+    if record_number - first_record + 1 != expected_records:
+        raise ValueError("Unbalanced quotes in the CSV between bytes {} and "
+                         "{}, use the sequential reader for this file."
+                         .format(start, end))
+
+    builder = _range_process['builder']
+    groups = [(group, line, lines if compact else rows,
+               build_records(builder, rows, line, compact))
+              for group, line, rows, lines in groups]
+    return groups, os.getpid(), get_cache_stats(builder)
+
+
+class CsvRangeReader(CsvBatchReader):
+    """
+    Reads the CSV in batches like CsvBatchReader, but splits the data file in
+    byte ranges that are parsed and transformed independently by a pool of
+    processes. Each range boundary is snapped to the start of a record, taking
+    quoted fields into account, and the records of each range are counted
+    beforehand so that the batch numbers and line numbers are the same as
+    when reading the file sequentially.
+    """
+    def __init__(self, csv_file, batch_size=100, start_at=1, delimiter=",",
+                 single_pass=False, parse_workers=0, max_batch_bytes=0,
+                 compact_batches=False, shard=None, range_size=RANGE_SIZE):
+        super(CsvRangeReader, self).__init__(
+            csv_file, batch_size, start_at, delimiter, single_pass=single_pass,
+            parse_workers=parse_workers or os.cpu_count(),
+            max_batch_bytes=max_batch_bytes, compact_batches=compact_batches,
+            shard=shard)
+        if self.compression:
+            raise Exception("Compressed data files can't be split in ranges.")
+        self.range_size = range_size
+        self.total_records = None
+        self._builder = None
+
+    def estimate_total_records(self):
+        if self.total_records is None:
+            return self.records_read
+        return count_shard_records(
+            max(self.total_records - (self.start_at - 1), 0), self.start_at,
+            self.batch_size, self.shard)
+
+    def build_batches(self):
+        if not self.single_pass:
+            self.utf8_validate(self.csv_file)
+        self.records_read = 0
+
+        with open(self.csv_file, "rb") as f:
+            reader = csv.reader(self.decode_lines(f), delimiter=self.delimiter)
+            self.header = next(reader, None)
+            self.header_bytes = self.bytes_read
+            header_lines = self.lines_read
+        if self.header is None or self.header_bytes == self.file_size:
+            return
+
+        self._builder = self.get_record_builder(self.header)
+        executor = ProcessPoolExecutor(
+            max_workers=self.parse_workers,
+            initializer=init_range_process,
+            initargs=(self.csv_file, self._builder, self.delimiter,
+                      self.compact_batches))
+        try:
+            ranges = self.split_ranges(executor, header_lines)
+            yield from self.read_ranges(executor, ranges)
+        finally:
+            executor.shutdown()
+
+    def split_ranges(self, executor, header_lines):
+        """
+        Split the data after the header in ranges of about `range_size` bytes
+        starting at a record, and count the records and lines of each range.
+
+        Returns:
+            A list of tuples with the start and end offsets, the first record
+            number, the first line number and the number of records of each
+            range.
+        """
+        bounds = list(range(self.header_bytes, self.file_size,
+                            self.range_size)) + [self.file_size]
+        quotes = list(executor.map(count_range_quotes, bounds[:-1],
+                                   bounds[1:]))
+
+        # Move each boundary forward to the first newline outside of a quoted
+        # field, which is where the next record starts.
+        starts = [self.header_bytes]
+        with open(self.csv_file, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                quotes_before = 0
+                for i, position in enumerate(bounds[1:-1]):
+                    quotes_before += quotes[i]
+                    start = snap_to_record(data, position, quotes_before % 2,
+                                           self.file_size)
+                    if starts[-1] < start < self.file_size:
+                        starts.append(start)
+            finally:
+                data.close()
+        ends = starts[1:] + [self.file_size]
+
+        counts = executor.map(count_range_records, starts, ends)
+        ranges = []
+        record_number = 1
+        line_number = header_lines + 1
+        for start, end, (records, lines) in zip(starts, ends, counts):
+            ranges.append((start, end, record_number, line_number, records))
+            record_number += records
+            line_number += lines
+        self.total_records = record_number - 1
+        logger.info("Split {} records in {} ranges".format(
+            self.total_records, len(ranges)))
+        return ranges
+
+    def read_ranges(self, executor, ranges):
+        """
+        Join the groups of records split between ranges into batches.
+        """
+        first_group = (self.start_at - 1) // self.batch_size
+        batch = None
+        for groups, process, stats in self._parse_ranges(executor, ranges):
+            self.update_cache_stats(self._builder, process, stats)
+            for group in groups:
+                if batch and batch[0] == group[0]:
+                    batch[2].extend(group[2])
+                    batch[3].extend(group[3])
+                    continue
+                if batch:
+                    yield self._make_batch(first_group, *batch)
+                batch = group
+        if batch:
+            yield self._make_batch(first_group, *batch)
+
+    def _parse_ranges(self, executor, ranges):
+        """
+        Parse the ranges in the pool, yielding the results in order. A limited
+        number of ranges is parsed ahead to bound the memory used.
+        """
+        pending = deque()
+        try:
+            for start, end, first_record, first_line, records in ranges:
+                if first_record + records <= self.read_from:
+                    continue
+                pending.append(executor.submit(
+                    parse_range, start, end, first_record, first_line,
+                    records, self.start_at, self.batch_size, self.shard,
+                    self.read_from))
+                if len(pending) >= 2 * self.parse_workers:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _make_batch(self, first_group, group, start_line, rows, records):
+        self.records_read += len(records)
+        return self.make_batch(self._builder, records, rows,
+                               group - first_group + 1, start_line,
+                               start_line + len(records) - 1)
+
+
+def snap_to_record(data, position, in_quotes, end):
+    """
+    Find the start of the first record at or after a position of the data.
+
+    Args:
+        data      - The memory map of the data file
+        position  - Offset to start looking from
+        in_quotes - Whether the position is inside a quoted field
+        end       - Offset of the end of the data
+    """
+    while position < end:
+        newline = data.find(b"\n", position, end)
+        if newline == -1:
+            return end
+        in_quotes ^= data[position:newline].count(b'"') % 2
+        position = newline + 1
+        if not in_quotes:
+            return position
+    return end
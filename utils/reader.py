@@ -1,12 +1,22 @@
 import csv
-import codecs
-from utils.utils import expand_objects
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from utils.index import DEFAULT_STRIDE, RecordIndex
+from utils.utils import (STDIN, copy_value, encode_json, get_compression,
+                         merge_dicts, open_binary_file, open_data_file)
 
 import logging
 logger = logging.getLogger(__name__)
 
+BOM = b'\xef\xbb\xbf'
+
 
 class BaseBatch(object):
+    __slots__ = ('id', 'records', 'original_records')
+
     def __init__(self, records, original_records, batch_id=None):
         self.id = batch_id
         self.records = records
@@ -14,18 +24,397 @@ class BaseBatch(object):
 
 
 class CsvBatch(BaseBatch):
+    __slots__ = ('start_line', 'end_line')
+
     def __init__(self, records, original_records, batch_id=None, start_line=1,
                  end_line=101):
         super(CsvBatch, self).__init__(records, original_records, batch_id)
         self.start_line = start_line
         self.end_line = end_line
 
+    def iter_records(self):
+        """
+        Returns an iterator over the records of the batch.
+        """
+        return iter(self.records)
+
+    def slice(self, start, end, batch_id):
+        """
+        Returns a new batch with the records between two positions.
+        """
+        return CsvBatch(self.records[start:end],
+                        self.original_records[start:end], batch_id,
+                        self.start_line + start, self.start_line + end - 1)
+
+
+class CompactCsvBatch(CsvBatch):
+    """
+    Batch keeping the transformed values of each record in a tuple ordered
+    like the header, and each original record as the raw text read from the
+    CSV. The records are only built when they are first accessed, usually by
+    the worker making the API call, and the original records are parsed again
+    only when they are needed.
+
+    Args:
+        builder  - The RecordBuilder used to build the records
+        values   - List of tuples with the transformed values of each record
+        lines    - List with the raw text of each record
+        delimiter - Delimiter used to parse the raw text of the records
+    """
+    __slots__ = ('builder', 'values', 'lines', 'delimiter', '_records')
+
+    def __init__(self, builder, values, lines, delimiter=",", batch_id=None,
+                 start_line=1, end_line=101):
+        self.builder = builder
+        self.values = values
+        self.lines = lines
+        self.delimiter = delimiter
+        self.id = batch_id
+        self.start_line = start_line
+        self.end_line = end_line
+        self._records = None
+
+    @property
+    def records(self):
+        if self._records is None:
+            self._records = [self.builder.assemble(values)
+                             for values in self.values]
+        return self._records
+
+    @property
+    def original_records(self):
+        return list(csv.reader(self.lines, delimiter=self.delimiter))
+
+    def iter_records(self):
+        """
+        Build the records one at a time without keeping them, so that the
+        reader can size them while the records are still only built by the
+        worker.
+        """
+        if self._records is not None:
+            return iter(self._records)
+        return (self.builder.assemble(values) for values in self.values)
+
+    def slice(self, start, end, batch_id):
+        return CompactCsvBatch(self.builder, self.values[start:end],
+                               self.lines[start:end], self.delimiter,
+                               batch_id, self.start_line + start,
+                               self.start_line + end - 1)
+
+
+class LineBuffer(object):
+    """
+    Iterator over lines keeping the lines consumed since the last call to
+    pop(). Used as the input of a csv.reader to get the raw text of each
+    record, which may span several lines.
+    """
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = next(self.lines)
+        self.buffer.append(line)
+        return line
+
+    def pop(self):
+        """
+        Returns the text of the lines consumed since the last call.
+        """
+        text = "".join(self.buffer)
+        self.buffer.clear()
+        return text
+
+
+def is_column_transformation(transformation):
+    """
+    Whether a transformation receives a whole column of values, see the
+    column_transformation decorator in transformations.py.
+    """
+    return getattr(transformation, "column_transformation", False)
+
+
+class CachedTransformation(object):
+    """
+    Wraps a transformation with a LRU cache of its results by value, for the
+    columns with many repeated values. Lists and dicts are copied when they
+    are returned, so that the records never share a cached result. A column
+    transformation is applied to the values missing from the cache one at a
+    time.
+
+    The cache is not pickled, each process of a pool has its own cache.
+
+    Args:
+        transformation - The transformation function
+        cache_size     - Maximum number of values kept in the cache
+    """
+    def __init__(self, transformation, cache_size):
+        self.transformation = transformation
+        self.cache_size = cache_size
+        self.__name__ = transformation.__name__
+        self.__doc__ = transformation.__doc__
+        self._cached = None
+
+    def __call__(self, value):
+        if self._cached is None:
+            self._cached = lru_cache(maxsize=self.cache_size)(self._transform)
+        result = self._cached(value)
+        if isinstance(result, (list, dict)):
+            return copy_value(result)
+        return result
+
+    def _transform(self, value):
+        if is_column_transformation(self.transformation):
+            return self.transformation([value])[0]
+        return self.transformation(value)
+
+    def cache_info(self):
+        """
+        Returns a tuple with the cache hits and misses so far.
+        """
+        if self._cached is None:
+            return 0, 0
+        info = self._cached.cache_info()
+        return info.hits, info.misses
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cached'] = None
+        return state
+
+
+def get_cache_stats(builder):
+    """
+    Returns the cache hits and misses of the cached transformations of a
+    RecordBuilder, by column.
+    """
+    return {column: transformation.cache_info()
+            for column, transformation in zip(builder.header,
+                                              builder.transformations)
+            if isinstance(transformation, CachedTransformation)}
+
+
+class RecordBuilder(object):
+    """
+    Builds the records of a CSV file following a plan compiled once from the
+    header. Each column gets a fixed transformation slot and the attributes
+    expressed in dot-notation get their path precomputed, so each record is
+    built in a single pass without any lookups by column name.
+
+    Args:
+        header          - List of column names
+        transformations - Dictionary of transformation functions by column
+    """
+    def __init__(self, header, transformations):
+        self.header = list(header)
+        self.transformations = [transformations.get(column)
+                                for column in self.header]
+        self.column_transformations = [
+            is_column_transformation(transformation)
+            for transformation in self.transformations]
+        self.columns, self.paths = self.compile(self.header)
+
+    @staticmethod
+    def compile(header):
+        """
+        Split the header into the list of plain columns and the list of
+        attributes expressed in dot-notation with their precomputed path.
+        """
+        columns = []
+        paths = []
+        # A repeated column keeps the position of its first occurrence and
+        # the value of the last one.
+        positions = {}
+        for i, column in enumerate(header):
+            positions[column] = i
+        for column, i in positions.items():
+            parts = column.split(".")
+            if len(parts) > 1:
+                paths.append((i, tuple(parts[:-1]), parts[-1]))
+            else:
+                columns.append((i, column))
+        return columns, paths
+
+    def transform(self, row):
+        """
+        Apply the transformations to a row, returning the list of values. If
+        there is no transformation for a column, the value is kept or None is
+        returned for an empty value.
+        """
+        values = []
+        for column, transformation, by_column, value in zip(
+                self.header, self.transformations,
+                self.column_transformations, row):
+            if transformation is not None:
+                try:
+                    if by_column:
+                        value = transformation([value])[0]
+                    else:
+                        value = transformation(value)
+                except ValueError as e:
+                    raise ValueError("{} on attribute {}".format(str(e),
+                                                                 column)
+                                     ) from None
+            elif not value:
+                value = None
+            values.append(value)
+        return values
+
+    def transform_rows(self, rows):
+        """
+        Apply the transformations column by column to a list of rows. Column
+        transformations receive all the values of their column at once, the
+        other transformations are applied to each value.
+
+        Returns:
+            A list with a tuple of values for each row, or None if a row is
+            shorter than the header and the rows must be transformed one by
+            one.
+        """
+        width = len(self.header)
+        if any(len(row) < width for row in rows):
+            return None
+
+        columns = []
+        for transformation, by_column, values in zip(
+                self.transformations, self.column_transformations,
+                zip(*rows)):
+            if transformation is None:
+                values = [value or None for value in values]
+            elif by_column:
+                values = transformation(values)
+                if len(values) != len(rows):
+                    raise Exception("Column transformation {} returned {} "
+                                    "values for {} rows".format(
+                                        transformation.__name__,
+                                        len(values), len(rows)))
+            else:
+                values = [transformation(value) for value in values]
+            columns.append(values)
+        return list(zip(*columns))
+
+    def build(self, row):
+        """
+        Transform a row and build the record with the attributes expressed in
+        dot-notation expanded into nested objects.
+        """
+        return self.assemble(self.transform(row))
+
+    def assemble(self, values):
+        """
+        Build the record from the values already transformed.
+        """
+        columns = self.columns
+        paths = self.paths
+        if len(values) < len(self.header):
+            columns, paths = self.compile(self.header[:len(values)])
+
+        record = {column: values[i] for i, column in columns}
+        for i, parents, name in paths:
+            node = record
+            for part in parents:
+                child = node.get(part)
+                if not isinstance(child, dict):
+                    child = node[part] = {}
+                node = child
+            value = values[i]
+            if isinstance(value, dict) and isinstance(node.get(name), dict):
+                merge_dicts(node[name], value)
+            else:
+                node[name] = value
+        return record
+
+
+def build_records(builder, rows, start_line, compact=False):
+    """
+    Build the records of a batch of rows.
+
+    Args:
+        builder    - A RecordBuilder instance
+        rows       - List of rows read from the CSV
+        start_line - Line number of the first row, used for error messages
+        compact    - Only transform the rows, returning a tuple with the
+                     values of each record instead of the record
+    """
+    try:
+        records = builder.transform_rows(rows)
+    except ValueError:
+        # Transform the rows one by one to find the line with the error.
+        records = None
+    if records is not None:
+        if compact:
+            return records
+        return [builder.assemble(values) for values in records]
+
+    records = []
+    for line, row in enumerate(rows, start_line):
+        try:
+            if compact:
+                records.append(tuple(builder.transform(row)))
+            else:
+                records.append(builder.build(row))
+        except ValueError as e:
+            # Log a more clear message on where the error is located in the
+            # CSV
+            logger.error("{} error on CSV line {}: {}".format(type(e), line,
+                                                              e))
+            raise e
+    return records
+
+
+# The RecordBuilder is sent once to each process of the pool when the records
+# are transformed in parallel, instead of along with every batch.
+_process_record_builder = None
+
+
+def init_record_builder(builder):
+    global _process_record_builder
+    _process_record_builder = builder
+
+
+def build_batch_records(rows, start_line, compact=False):
+    """
+    Build the records of a batch in a process of the pool. The cache stats of
+    the process are returned with the records.
+    """
+    builder = _process_record_builder
+    records = build_records(builder, rows, start_line, compact)
+    return records, os.getpid(), get_cache_stats(builder)
+
 
 class BaseUtf8Reader(object):
     def __init__(self):
         self._transformations = {}
+        self.file_has_bom = False
+        self.build_index = False
+        self.streaming = False
+        self.compact_batches = False
+        self.index_stride = DEFAULT_STRIDE
+        self.bytes_read = 0
+        self.lines_read = 0
+        self.header_bytes = 0
+        self.records_seen = 0
+        self._line_buffer = None
+        # Cache stats of the cached transformations, by process
+        self._cache_stats = {}
 
-    def add_transformation(self, attribute, transformation_func):
+    def add_transformation(self, attribute, transformation_func,
+                           cache_size=None):
+        """
+        Add the transformation of a column.
+
+        Args:
+            attribute           - Name of the column
+            transformation_func - The transformation function
+            cache_size          - If set, the results of the transformation
+                                  are cached for this number of values
+        """
+        if cache_size:
+            transformation_func = CachedTransformation(transformation_func,
+                                                       cache_size)
         self._transformations[attribute] = transformation_func
 
     def transform(self, column, value):
@@ -33,8 +422,12 @@ class BaseUtf8Reader(object):
         # Otherwise return the own value or None.
         # Note: All values received from CSV are formatted as a string.
         if column in self._transformations:
+            transformation = self._transformations[column]
             try:
-                new_value = self._transformations[column](value)
+                if is_column_transformation(transformation):
+                    new_value = transformation([value])[0]
+                else:
+                    new_value = transformation(value)
             except ValueError as e:
                 raise ValueError("{} on attribute {}".format(str(e), column)
                                  ) from None
@@ -46,6 +439,12 @@ class BaseUtf8Reader(object):
         else:
             return value
 
+    def get_record_builder(self, header):
+        """
+        Compile the header and the transformations into a RecordBuilder.
+        """
+        return RecordBuilder(header, self._transformations)
+
     def get_plurals(self):
         """
         Returns a list of Plural attributes defined in current schema,
@@ -59,111 +458,491 @@ class BaseUtf8Reader(object):
                 plurals_to_update.append(field_name)
         return plurals_to_update
 
+    def update_cache_stats(self, builder, process=None, stats=None):
+        """
+        Keep the cache stats of the transformations of a process, those of
+        the current process are read from the builder.
+        """
+        if process is None:
+            process = os.getpid()
+            stats = get_cache_stats(builder)
+        if stats:
+            self._cache_stats[process] = stats
+
+    def log_cache_stats(self):
+        totals = {}
+        for stats in self._cache_stats.values():
+            for column, (hits, misses) in stats.items():
+                total_hits, total_misses = totals.get(column, (0, 0))
+                totals[column] = (total_hits + hits, total_misses + misses)
+        for column, (hits, misses) in totals.items():
+            logger.info("Transformation cache of '{}': {} hits, {} misses "
+                        "({:.1f}% hit rate)".format(
+                            column, hits, misses,
+                            100 * hits / max(hits + misses, 1)))
+
+    def decode_lines(self, f):
+        """
+        Decode the lines of a binary file object as UTF-8. The encoding is
+        validated while the lines are read and the number of bytes and lines
+        consumed are kept in `bytes_read` and `lines_read`. A Byte Order Mark
+        at the beginning of the file is skipped.
+        """
+        for line in f:
+            position = self.bytes_read
+            self.bytes_read += len(line)
+            self.lines_read += 1
+            # check for BOM first - usually appears if file was exported from
+            # MS Excel
+            if position == 0 and line.startswith(BOM):
+                logger.info("Byte Order Mark detected.")
+                self.file_has_bom = True
+                line = line[len(BOM):]
+            try:
+                yield line.decode("utf-8")
+            except UnicodeDecodeError as error:
+                logger.error("Line {}: {}".format(self.lines_read, str(error)))
+                raise error
+
     def utf8_validate(self, csv_file):
         logger.info("Validating UTF-8 encoding and checking for Byte Order\
                     Mark")
-        # check for BOM first - usually appears if file was exported from
-        # MS Excel
-        with open(csv_file, "rb") as f:
-            if (f.read(3) == b'\xef\xbb\xbf'):
-                logger.info("Byte Order Mark detected.")
-                self.file_has_bom = True
+        with open_data_file(csv_file) as f:
+            for _ in self.decode_lines(f):
+                pass
+        self.bytes_read = 0
+        self.lines_read = 0
+
+    def read_records(self, f, start_at=1):
+        """
+        Read the header of a CSV file opened in binary mode and return an
+        iterator over its records. The header is stored in `header` and each
+        record is yielded as a tuple with the record number (the first record
+        after the header is record 1) and the parsed row.
+
+        When a record index exists for the file, the reader seeks to the
+        closest indexed record before `start_at`. The records before
+        `start_at` may still be yielded and must be skipped by the caller.
+        If `build_index` is enabled and the whole file is read, the index is
+        built and saved next to the data file.
+        """
+        self.bytes_read = 0
+        self.lines_read = 0
+        self.records_seen = 0
+        reader = csv.reader(self.read_lines(f), delimiter=self.delimiter)
+        self.header = next(reader, None)
+        self.header_bytes = self.bytes_read
+        if self.header is None:
+            return iter(())
+        self.pop_raw_record()
+
+        # A stream can't be indexed.
+        if self.streaming:
+            return self._enumerate_records(reader, 1)
+
+        index = None
+        position = None
+        if start_at > 1:
+            index = RecordIndex.load(self.csv_file)
+            position = index.lookup(start_at) if index else None
+
+        if position:
+            record_number, offset, line_number = position
+            logger.info("Seeking to record {} at byte offset {}".format(
+                record_number, offset))
+            f.seek(offset)
+            self.bytes_read = offset
+            self.lines_read = line_number - 1
+            self.records_seen = record_number - 1
+            reader = csv.reader(self.read_lines(f), delimiter=self.delimiter)
+            return self._enumerate_records(reader, record_number)
+        elif self.build_index and not index:
+            return self._index_records(reader)
+        return self._enumerate_records(reader, 1)
+
+    def read_lines(self, f):
+        """
+        Returns the decoded lines of a file object for the CSV parser. With
+        compact batches the lines go through a LineBuffer to keep the raw
+        text of the records.
+        """
+        lines = self.decode_lines(f)
+        self._line_buffer = None
+        if self.compact_batches:
+            lines = self._line_buffer = LineBuffer(lines)
+        return lines
+
+    def pop_raw_record(self):
+        """
+        Returns the raw text of the last record read, when the lines are kept
+        for compact batches.
+        """
+        if self._line_buffer is not None:
+            return self._line_buffer.pop()
+        return None
+
+    def _enumerate_records(self, reader, record_number):
+        for record_number, row in enumerate(reader, record_number):
+            self.records_seen += 1
+            yield record_number, row
+
+    def _index_records(self, reader):
+        index = RecordIndex(self.csv_file, self.index_stride)
+        offset = self.bytes_read
+        line_number = self.lines_read + 1
+        for record_number, row in enumerate(reader, 1):
+            self.records_seen += 1
+            index.add(record_number, offset, line_number)
+            yield record_number, row
+            offset = self.bytes_read
+            line_number = self.lines_read + 1
+        index.save()
+
+
+def in_shard(batch_number, shard):
+    """
+    Tell if a batch of the data file is loaded by a shard.
+
+    Args:
+        batch_number - Number of the batch in the data file, from 1
+        shard        - Tuple with the number of the shard, from 1, and the
+                       number of shards, or None to load all the batches
+    """
+    return shard is None or (batch_number - 1) % shard[1] == shard[0] - 1
 
-        f = codecs.open(csv_file, encoding='utf8', errors='strict')
-        line_number = 1
-        try:
-            for _, _ in enumerate(f):
-                line_number += 1
-        except UnicodeDecodeError as error:
-            logger.error("Line {}: {}".format(line_number, str(error)))
-            raise error
+
+def next_shard_batch(batch_number, shard):
+    """
+    Returns the number of the first batch of a shard after `batch_number`.
+    """
+    if shard is None:
+        return batch_number + 1
+    elif batch_number < shard[0]:
+        return shard[0]
+    return batch_number + shard[1]
+
+
+def count_shard_records(records, start_at, batch_size, shard):
+    """
+    Count the records loaded by a shard, out of the `records` read from the
+    `start_at` record. The batches end on a multiple of the batch size, so the
+    first one may be shorter, as may the last one.
+    """
+    if shard is None or records <= 0:
+        return records
+    index, count = shard
+    first_batch = batch_size - (start_at - 1) % batch_size
+    batches = 1 + max(0, -(-(records - first_batch) // batch_size))
+    if batches < index:
+        return 0
+
+    # Count full batches, then remove the records missing from the first and
+    # last batches if they belong to the shard.
+    total = ((batches - index) // count + 1) * batch_size
+    if index == 1:
+        total -= batch_size - min(first_batch, records)
+    if batches > 1 and (batches - index) % count == 0:
+        last_batch = records - first_batch - (batches - 2) * batch_size
+        total -= batch_size - last_batch
+    return total
 
 
 class CsvBatchReader(BaseUtf8Reader):
-    def __init__(self, csv_file, batch_size=100, start_at=1, delimiter=","):
+    """
+    Reads the CSV in batches of `batch_size` records, transformed to the JSON
+    structure expected by the API. With a `shard`, only the batches of the
+    shard are transformed and yielded, with their number in the whole file,
+    so that several imports can load the same file in parallel.
+    """
+    def __init__(self, csv_file, batch_size=100, start_at=1, delimiter=",",
+                 single_pass=False, build_index=False, parse_workers=0,
+                 max_batch_bytes=0, compact_batches=False, shard=None):
         super(CsvBatchReader, self).__init__()
         self.delimiter = delimiter
         self.csv_file = csv_file
         self.batch_size = batch_size
         self.header = None
         self.start_at = start_at
+        # First record read, after the batches completed by a resumed import
+        self.read_from = start_at
+        # Number of the batch the split batches are numbered after
+        self.resumed_batch = 0
         self.plural_processor = None
-        self.file_has_bom = False
-        self.file_descriptor = open(csv_file, encoding="utf-8")
+        # A stream can only be read once, so it is always read in single pass
+        # mode and its size is unknown.
+        self.streaming = csv_file == STDIN
+        self.single_pass = single_pass or self.streaming
+        self.build_index = build_index
+        self.parse_workers = parse_workers
+        self.max_batch_bytes = max_batch_bytes
+        self.compact_batches = compact_batches
+        self.shard = shard
+        self.file_size = None
+        if not self.streaming:
+            self.file_size = os.path.getsize(csv_file)
+        self.compression = get_compression(csv_file)
+        self.records_read = 0
+        self._records = None
+        self._raw_file = None
+        self._data_file = None
 
         if self.batch_size <= 2:
             raise Exception("Batch size must be greater than 2.")
 
     def get_header(self):
-        self.header = self.file_descriptor.readline()
-        self.header = self.header.strip()
-        return self.header.split(self.delimiter)
+        # The header can only be read once from a stream, the records are then
+        # read from the same position.
+        if self.streaming:
+            if self._records is None:
+                self._records = self._open_records()
+            return self.header
+
+        with open_data_file(self.csv_file) as f:
+            reader = csv.reader(self.decode_lines(f), delimiter=self.delimiter)
+            self.header = next(reader, [])
+        self.bytes_read = 0
+        self.lines_read = 0
+        return self.header
+
+    def resume_after(self, batch_id, last_record):
+        """
+        Start reading after the last record of a batch completed by the import
+        being resumed, instead of reading the batches before it again. The
+        record must end a batch of `batch_size` records, so that the next
+        batches are made of the same records and numbered after `batch_id`.
+
+        Returns:
+            The number of records of the shard which are not read
+        """
+        self.read_from = last_record + 1
+        self.resumed_batch = batch_id
+        return count_shard_records(last_record - (self.start_at - 1),
+                                   self.start_at, self.batch_size, self.shard)
+
+    def estimate_total_records(self):
+        """
+        Estimate the number of records to be processed based on the average
+        size of the records read so far. Used to refine the progress bar total
+        when the records are not counted before the import.
+        """
+        if self.streaming:
+            return None
+        elif self.compression:
+            # Compare the compressed data consumed with the file size.
+            data_read = 0
+            if self._raw_file and not self._raw_file.closed:
+                data_read = self._raw_file.tell()
+            data_size = self.file_size
+        else:
+            data_read = self.bytes_read - self.header_bytes
+            data_size = self.file_size - self.header_bytes
+        if not self.records_seen or not data_read:
+            return self.records_read
+        total = round(self.records_seen * data_size / data_read)
+        total = count_shard_records(max(total - (self.start_at - 1), 0),
+                                    self.start_at, self.batch_size, self.shard)
+        return max(total, self.records_read)
+
+    def _open_records(self):
+        self._raw_file = open_binary_file(self.csv_file)
+        self._data_file = self._raw_file
+        if self.compression:
+            self._data_file = self.compression(self._raw_file, "rb")
+        return self.read_records(self._data_file, self.read_from)
+
+    def _close_records(self):
+        self._data_file.close()
+        self._raw_file.close()
+
+    def read_batches(self):
+        """
+        Read the CSV file and group the rows in batches, without transforming
+        them. Yields tuples with the batch number, the first and last line
+        numbers, the list of rows and the list with the raw text of the
+        records (None unless compact batches are used) of each batch. The
+        rows of the batches of other shards are read but not kept.
+        """
+        # In single pass mode the UTF-8 encoding is validated while the
+        # records are read, so the first batch is available right away.
+        if not self.single_pass:
+            self.utf8_validate(self.csv_file)
+        self.records_read = 0
+
+        records, self._records = self._records, None
+        if records is None:
+            records = self._open_records()
+
+        try:
+            batch = []
+            lines = [] if self.compact_batches else None
+            # The batches are numbered from the one of `start_at`.
+            batch_number = ((self.read_from - 1) // self.batch_size -
+                            (self.start_at - 1) // self.batch_size + 1)
+            selected = in_shard(batch_number, self.shard)
+            line = None
+
+            for record_number, row in records:
+                line = record_number + 1
+                raw_record = self.pop_raw_record()
+                if record_number < self.read_from:
+                    continue
+                elif (record_number > self.read_from and
+                        (line - 2) % self.batch_size == 0):
+                    if selected:
+                        yield (batch_number, line - len(batch), line - 1,
+                               batch, lines)
+                    batch_number += 1
+                    selected = in_shard(batch_number, self.shard)
+                    batch = []
+                    lines = [] if self.compact_batches else None
+
+                if not selected:
+                    continue
+                batch.append(row)
+                if lines is not None:
+                    lines.append(raw_record)
+                self.records_read += 1
+
+            if batch:
+                yield batch_number, line - len(batch) + 1, line, batch, lines
+        finally:
+            self._close_records()
 
     def __iter__(self):
-        self.utf8_validate(self.csv_file)
-        f = self.file_descriptor
-        # Reset the file to the initial position
-        f.seek(0)
-        # if the file has a BOM, start reading after those bytes
-        if self.file_has_bom:
-            f.seek(3)
-        reader = csv.reader(f, delimiter=self.delimiter)
-        batch = []
-        batch_original = []
-        batch_number = 0
-
-        for i, row in enumerate(reader):
-            line = i + 1
-            start_line = line - len(batch)
-            end_line = line - 1
-            if (i == 0):
-                self.header = row
-                continue
-            elif (line < (self.start_at + 1)):
-                continue
-            elif line > 2 and ((line - 2) % self.batch_size == 0):
-                batch_number += 1
-                yield CsvBatch(batch, batch_original, batch_number,
-                               start_line, end_line)
-                batch = []
-                batch_original = []
-
-            # process the row
-            try:
-                transformed = [self.transform(self.header[i], value)
-                               for i, value in enumerate(row)]
-            except ValueError as e:
-                # Log a more clear message on where the error is located in
-                # the CSV
-                logger.error("{} error on CSV line {}: {}".format(type(e),
-                                                                  line, e))
-                raise e
-            record = expand_objects(dict(zip(self.header, transformed)))
-            batch.append(record)
-            batch_original.append(row)
+        batches = self.build_batches()
+        if self.max_batch_bytes:
+            batches = self.split_batches(batches)
+        yield from batches
+        self.log_cache_stats()
+
+    def build_batches(self):
+        batches = self.read_batches()
+        if self.parse_workers >= 1:
+            yield from self._build_batches_in_processes(batches)
+            return
 
-        batch_number += 1
-        yield CsvBatch(batch, batch_original, batch_number, start_line,
-                       end_line + 1)
+        builder = None
+        for batch_number, start_line, end_line, rows, lines in batches:
+            if builder is None:
+                builder = self.get_record_builder(self.header)
+            records = build_records(builder, rows, start_line,
+                                    self.compact_batches)
+            if lines is not None:
+                rows = lines
+            yield self.make_batch(builder, records, rows, batch_number,
+                                  start_line, end_line)
+        if builder is not None:
+            self.update_cache_stats(builder)
+
+    def make_batch(self, builder, records, original_records, batch_number,
+                   start_line, end_line):
+        """
+        Returns a CsvBatch, or a CompactCsvBatch with the transformed values
+        and the raw text of the records when compact batches are used.
+        """
+        if self.compact_batches:
+            return CompactCsvBatch(builder, records, original_records,
+                                   self.delimiter, batch_number, start_line,
+                                   end_line)
+        return CsvBatch(records, original_records, batch_number, start_line,
+                        end_line)
+
+    def _build_batches_in_processes(self, batches):
+        """
+        Transform the batches in a pool of processes. The batches are still
+        yielded in the order they were read, a limited number of them is
+        transformed ahead to bound the memory used.
+        """
+        pending = deque()
+        executor = None
+        builder = None
+        try:
+            for batch_number, start_line, end_line, rows, lines in batches:
+                if executor is None:
+                    builder = self.get_record_builder(self.header)
+                    executor = ProcessPoolExecutor(
+                        max_workers=self.parse_workers,
+                        initializer=init_record_builder,
+                        initargs=(builder,))
+
+                future = executor.submit(build_batch_records, rows,
+                                         start_line, self.compact_batches)
+                if lines is not None:
+                    rows = lines
+                pending.append((future, rows, batch_number, start_line,
+                                end_line))
+                if len(pending) >= 2 * self.parse_workers:
+                    yield self._finish_batch(builder, *pending.popleft())
+
+            while pending:
+                yield self._finish_batch(builder, *pending.popleft())
+        finally:
+            if executor is not None:
+                for future, *_ in pending:
+                    future.cancel()
+                executor.shutdown()
+
+    def _finish_batch(self, builder, future, original_records, batch_number,
+                      start_line, end_line):
+        records, process, stats = future.result()
+        self.update_cache_stats(builder, process, stats)
+        return self.make_batch(builder, records, original_records,
+                               batch_number, start_line, end_line)
+
+    def split_batches(self, batches):
+        """
+        Split the batches so that the records of each one do not exceed
+        `max_batch_bytes` once encoded as JSON for the API call. The size of
+        each record is estimated from the transformed record, without keeping
+        the records of compact batches, and a record larger than the limit is
+        sent alone. The batches are numbered again in the order they are
+        yielded, with the numbers of the shard.
+        """
+        batch_number = self.resumed_batch
+        for batch in batches:
+            start = 0
+            # Brackets of the JSON list
+            size = 2
+            for i, record in enumerate(batch.iter_records()):
+                # Record followed by the ", " separator
+                record_size = len(encode_json(record)) + 2
+                if i > start and size + record_size > self.max_batch_bytes:
+                    batch_number = next_shard_batch(batch_number, self.shard)
+                    yield batch.slice(start, i, batch_number)
+                    start = i
+                    size = 2
+                if size + record_size > self.max_batch_bytes:
+                    logger.warning("Record on CSV line {} is larger than the "
+                                   "maximum batch size: {} bytes".format(
+                                       batch.start_line + i, record_size))
+                size += record_size
+
+            batch_number = next_shard_batch(batch_number, self.shard)
+            if start == 0:
+                batch.id = batch_number
+                yield batch
+            else:
+                yield batch.slice(start, i + 1, batch_number)
 
 
 class CsvReader(BaseUtf8Reader):
-    def __init__(self, csv_file, delimiter=","):
+    def __init__(self, csv_file, delimiter=",", start_at=1, single_pass=False,
+                 build_index=False):
         super(CsvReader, self).__init__()
         self.delimiter = delimiter
         self.csv_file = csv_file
-        self.file_has_bom = False
+        self.header = None
+        self.start_at = start_at
+        self.streaming = csv_file == STDIN
+        self.single_pass = single_pass or self.streaming
+        self.build_index = build_index
 
     def __iter__(self):
-        self.utf8_validate(self.csv_file)
-        with open(self.csv_file, encoding="utf-8") as f:
-            # if the file has a BOM, start reading after those bytes
-            if self.file_has_bom:
-                f.seek(3)
-            reader = csv.reader(f, delimiter=self.delimiter)
-
-            for i, row in enumerate(reader):
-                if (i == 0):
+        if not self.single_pass:
+            self.utf8_validate(self.csv_file)
+        with open_data_file(self.csv_file) as f:
+            for record_number, row in self.read_records(f, self.start_at):
+                if record_number < self.start_at:
                     continue
                 yield row
 
@@ -174,12 +953,29 @@ class CsvWriter():
         self.file_stream = open(csv_filename, mode)
         self.csv_writer = csv.writer(self.file_stream, delimiter=',',
                                      quotechar='"')
+        # The worker threads write to the same file.
+        self._lock = threading.Lock()
 
     def get_filename(self):
         return self.file_stream.name
 
     def write_row(self, row):
-        self.csv_writer.writerow(row)
+        with self._lock:
+            self.csv_writer.writerow(row)
+
+    def write_lines(self, lines):
+        """
+        Write records as raw CSV text, such as the lines kept by a
+        CompactCsvBatch.
+        """
+        text = "".join(line if line.endswith("\n") else line + "\n"
+                       for line in lines)
+        with self._lock:
+            self.file_stream.write(text)
+
+    def flush(self):
+        with self._lock:
+            self.file_stream.flush()
 
     def close_file(self):
         self.file_stream.close()
@@ -0,0 +1,190 @@
+"""
+Result logs written by a dedicated thread in large buffered blocks, instead of
+a logging.FileHandler call per record from every worker.
+"""
+import atexit
+import queue
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Seconds between two flushes of the result files.
+FLUSH_INTERVAL = 1.0
+# Size of the write buffer of each result file.
+BUFFER_SIZE = 1024 * 1024
+
+# Markers of the queue items that are not rows.
+_FLUSH = object()
+_STOP = object()
+
+_result_logs = {}
+
+
+class ResultLog(object):
+    """
+    A CSV result log, such as the success or failure log of the import. The
+    lines are queued for the ResultWriter the log was opened with, which
+    writes them in the order they were queued.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._file = None
+        self._queue = None
+
+    def write(self, line):
+        self._queue.put((self._file, line))
+
+    def write_lines(self, lines):
+        """
+        Queue several lines at once, the lines of a batch are written
+        together.
+        """
+        if lines:
+            self._queue.put((self._file, "\n".join(lines)))
+
+
+def get_result_log(name):
+    """
+    Returns the result log with this name. Like logging.getLogger(), the same
+    instance is returned for the same name, so that the modules can get the
+    result logs before they are opened.
+    """
+    if name not in _result_logs:
+        _result_logs[name] = ResultLog(name)
+    return _result_logs[name]
+
+
+class ResultWriter(object):
+    """
+    Thread writing the lines queued by the result logs to their files. The
+    workers only put their lines in the queue, the writer thread appends them
+    to buffered files which are flushed every `flush_interval` seconds.
+
+    Args:
+        flush_interval - Seconds between two flushes of the files
+        buffer_size    - Size of the write buffer of each file
+    """
+    def __init__(self, flush_interval=FLUSH_INTERVAL,
+                 buffer_size=BUFFER_SIZE):
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self._queue = queue.SimpleQueue()
+        self._files = []
+        self._thread = threading.Thread(target=self._run,
+                                        name="ResultWriter", daemon=True)
+        self._thread.start()
+        # The lines queued are still written if the script exits before
+        # closing the writer.
+        atexit.register(self.close)
+
+    def open(self, name, filename, mode="w"):
+        """
+        Open the file of a result log, the lines written to the log are then
+        queued for this writer.
+        """
+        f = open(filename, mode, buffering=self.buffer_size)
+        self._files.append(f)
+        result_log = get_result_log(name)
+        result_log._file = f
+        result_log._queue = self._queue
+        return result_log
+
+    def when_written(self, callback, *args):
+        """
+        Call `callback` from the writer thread once the lines queued before
+        are written and flushed to the files, at the latest after the flush
+        interval.
+        """
+        self._queue.put((None, (callback, args)))
+
+    def flush(self):
+        """
+        Wait until the lines queued are written and flushed to the files.
+        """
+        if not self._thread.is_alive():
+            return
+        flushed = threading.Event()
+        self._queue.put((_FLUSH, flushed))
+        flushed.wait()
+
+    def close(self):
+        """
+        Write the lines queued and close the files.
+        """
+        if self._thread.is_alive():
+            self._queue.put((_STOP, None))
+            self._thread.join()
+        for f in self._files:
+            f.close()
+        self._files = []
+
+    def _run(self):
+        callbacks = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                target, value = self._queue.get(
+                    timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                target = value = None
+
+            if target is not _FLUSH and target is not _STOP:
+                if target is not None:
+                    try:
+                        target.write(value)
+                        target.write("\n")
+                    except Exception as error:
+                        logger.error("Error on writing to {}: {}".format(
+                            target.name, error))
+                elif value is not None:
+                    callbacks.append(value)
+                if time.monotonic() < deadline:
+                    continue
+
+            self._flush(callbacks)
+            callbacks = []
+            deadline = time.monotonic() + self.flush_interval
+            if target is _FLUSH:
+                value.set()
+            elif target is _STOP:
+                return
+
+    def _flush(self, callbacks):
+        for f in self._files:
+            try:
+                f.flush()
+            except Exception as error:
+                logger.error("Error on writing to {}: {}".format(
+                    f.name, error))
+        for callback, args in callbacks:
+            try:
+                callback(*args)
+            except Exception as error:
+                logger.error(str(error))
+
+
+def open_result_logs(writer, config, result_handlers, format_date):
+    """
+    Take the handlers of the result logs out of a logging configuration, and
+    open their files with the result writer instead.
+
+    Args:
+        writer          - A ResultWriter instance
+        config          - Dict of the logging configuration, the result
+                          handlers and loggers are removed from it
+        result_handlers - Dict of the name of the result log of each handler
+        format_date     - Date formatted in the filename pattern of the
+                          handlers
+
+    Returns:
+        A dict with the filename of each handler
+    """
+    filenames = {}
+    for handler, name in result_handlers.items():
+        handler_config = config["handlers"].pop(handler)
+        del config["loggers"][name]
+        filenames[handler] = handler_config["filename"].format(format_date)
+        writer.open(name, filenames[handler], handler_config.get("mode", "a"))
+    return filenames
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from utils.limiter import is_congestion_error
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRY_DELAY = 60
+
+
+class RetryPolicy(object):
+    """
+    Retry the API calls failing with a congestion error, after an exponential
+    backoff with full jitter: the n-th retry waits a random time between 0 and
+    `base_delay * 2 ** (n - 1)` seconds, up to `max_delay`. The error of the
+    last attempt is raised once the attempts are exhausted, to be logged to
+    the retry or fail files as before.
+
+    Args:
+        max_attempts - Number of attempts for each call, no retry if 1
+        base_delay   - Seconds of the first backoff
+        error_codes  - Dict of the 'api' and 'http' error codes to retry
+        max_delay    - Maximum seconds of a backoff
+    """
+    def __init__(self, max_attempts, base_delay, error_codes,
+                 max_delay=MAX_RETRY_DELAY):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.error_codes = error_codes
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.recovered = 0
+        self.exhausted = 0
+        self.retry_time = 0
+        # Number of calls per number of attempts made
+        self.attempts = [0] * (self.max_attempts + 1)
+
+    def backoff(self, attempt):
+        """
+        Returns the seconds to wait before the attempt following `attempt`.
+        """
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** (attempt - 1)))
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call `fn` until it succeeds, it fails with an error that is not
+        retried or the attempts are exhausted.
+        """
+        start_time = time.monotonic()
+        attempt = 1
+        while True:
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as error:
+                if not self._retry(error, attempt, start_time):
+                    raise
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+            else:
+                self._done(attempt, start_time, True)
+                return result
+
+    async def call_async(self, fn, *args, **kwargs):
+        """
+        Same as call(), for the coroutine functions of the asyncio engine.
+        """
+        start_time = time.monotonic()
+        attempt = 1
+        while True:
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as error:
+                if not self._retry(error, attempt, start_time):
+                    raise
+                await asyncio.sleep(self.backoff(attempt))
+                attempt += 1
+            else:
+                self._done(attempt, start_time, True)
+                return result
+
+    def _retry(self, error, attempt, start_time):
+        """
+        Tell if a failed attempt is retried, updating the statistics if not.
+        """
+        if not is_congestion_error(error, self.error_codes):
+            self._done(attempt, start_time, False)
+            return False
+        if attempt >= self.max_attempts:
+            with self._lock:
+                self.exhausted += 1
+            self._done(attempt, start_time, False)
+            return False
+        logger.warning("Attempt {} of {} failed, retrying: {}".format(
+            attempt, self.max_attempts, error))
+        with self._lock:
+            self.retries += 1
+        return True
+
+    def _done(self, attempts, start_time, success):
+        with self._lock:
+            self.calls += 1
+            self.attempts[attempts] += 1
+            if attempts > 1:
+                self.retry_time += time.monotonic() - start_time
+                if success:
+                    self.recovered += 1
+
+    def log_stats(self):
+        """
+        Log the number of calls retried, their outcome and the time taken by
+        the calls that were retried.
+        """
+        if not self.calls or self.max_attempts == 1:
+            return
+        retried = self.calls - self.attempts[1]
+        logger.info("{} of {} calls retried {} times, {} succeeded after a "
+                    "retry and {} exhausted their {} attempts, {:.1f}s per "
+                    "retried call on average".format(
+                        retried, self.calls, self.retries, self.recovered,
+                        self.exhausted, self.max_attempts,
+                        self.retry_time / retried if retried else 0))
+        logger.info("Calls per number of attempts: {}".format(", ".join(
+            "{}: {}".format(attempts, count)
+            for attempts, count in enumerate(self.attempts) if count)))
@@ -0,0 +1,114 @@
+import logging
+
+import requests
+from janrain.capture import Api
+from janrain.capture.api import (api_encode, generate_signature,
+                                 raise_api_exceptions)
+
+logger = logging.getLogger(__name__)
+
+
+class SessionApi(Api):
+    """
+    janrain.capture.Api making its calls through a requests.Session shared by
+    the worker threads, so that the connections to the API are kept alive and
+    reused instead of opening a new connection, with its TCP and TLS
+    handshakes, for each call.
+
+    Args:
+        api_url   - URL of the Capture API domain
+        defaults  - Parameters sent with every call (client_id, ...)
+        pool_size - Number of connections kept alive to the API, which
+                    should be at least the number of worker threads
+        timeout   - Seconds to wait for the connection and for each read of
+                    the response, requests.Timeout is raised after
+    """
+    def __init__(self, api_url, defaults={}, pool_size=10, timeout=None,
+                 **kwargs):
+        super().__init__(api_url, defaults, **kwargs)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._adapter = adapter
+        self._logged = (0, 0)
+
+    def call(self, api_call, **kwargs):
+        """
+        Same as janrain.capture.Api.call(), using the shared session.
+        """
+        # Encode values for the API (JSON, bools, nulls)
+        params = self.defaults.copy()
+        for key, value in kwargs.items():
+            if value is not None:
+                params[key] = value
+        params = {k: api_encode(v) for k, v in params.items()}
+
+        if api_call[0] != "/":
+            api_call = "/" + api_call
+        url = self.api_url + api_call
+
+        if self.sign_requests:
+            headers, params = generate_signature(api_call, params)
+        else:
+            headers = {}
+        headers['User-Agent'] = self.user_agent
+        if self.compress:
+            headers['Accept-Encoding'] = 'gzip'
+
+        r = self.session.post(url, headers=headers, data=params,
+                              timeout=self.timeout)
+
+        try:
+            raise_api_exceptions(r.json())
+            if r.status_code not in (200, 400, 401):
+                # /oauth/token returns 400 or 401
+                r.raise_for_status()
+            return r.json()
+        except ValueError:
+            # The response was not valid JSON (empty body, 5xx errors, etc.)
+            r.raise_for_status()
+
+    def connection_stats(self):
+        """
+        Returns the number of requests made and of connections opened by the
+        connection pools of the session.
+        """
+        pools = self._adapter.poolmanager.pools
+        requests_made = connections = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_made += pool.num_requests
+                connections += pool.num_connections
+        return requests_made, connections
+
+    def log_stats(self):
+        """
+        Log the number of requests made and of connections opened since the
+        last call, the requests made on the other connections reused them.
+        """
+        requests_made, connections = self.connection_stats()
+        logged_requests, logged_connections = self._logged
+        self._logged = (requests_made, connections)
+        log_connection_stats(requests_made - logged_requests,
+                             connections - logged_connections,
+                             self.pool_size, self.api_url)
+
+    def close(self):
+        self.session.close()
+
+
+def log_connection_stats(requests_made, connections, pool_size, url):
+    """
+    Log the number of requests made and the connections they were made on.
+    """
+    if not requests_made:
+        return
+    logger.info("{} requests made on {} connections to {} (pool size: {}), "
+                "{:.1f} requests per connection".format(
+                    requests_made, connections, url, pool_size,
+                    requests_made / max(1, connections)))
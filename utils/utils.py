@@ -1,6 +1,34 @@
+import bz2
 import copy
+import gzip
+import io
+import json
+import lzma
+import operator
 import os
-import time
+import sys
+from itertools import accumulate, chain, repeat
+
+# Data file name used to read from the standard input.
+STDIN = "-"
+
+# Size of the blocks read when counting the lines of a file.
+COUNT_BLOCK_SIZE = 1024 * 1024
+
+# Signatures of the supported compression formats and the function used to
+# open each of them.
+COMPRESSION_FORMATS = (
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+    (b'\xfd7zXZ\x00', lzma.open)
+)
+# Number of bytes read to match the signatures.
+SIGNATURE_SIZE = 6
+
+_stdin = None
+
+# Placeholder of the RawJson fragments in the JSON encoded by encode_json().
+RAW_JSON_PLACEHOLDER = '"\\u0000"'
 
 
 def merge_dicts(a, b):
@@ -40,6 +68,99 @@ def merge_dicts(a, b):
     return result
 
 
+def copy_value(value):
+    """
+    Recursively copy the lists and dicts of a value decoded from JSON. This is
+    much faster than deepcopy for such values, the other types are immutable
+    and are not copied.
+
+    Example:
+        >>> a = {'a': [{'b': 1}]}
+        >>> b = copy_value(a)
+        >>> a == b and (a is not b) and (a['a'][0] is not b['a'][0])
+        True
+    """
+    if isinstance(value, dict):
+        return {k: copy_value(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [copy_value(v) for v in value]
+    return value
+
+
+class RawJson(object):
+    """
+    A JSON fragment already validated, carried as the text read from the data
+    file. It is spliced as it is in the JSON built by encode_json() instead of
+    being decoded and encoded again.
+    """
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __eq__(self, other):
+        return isinstance(other, RawJson) and self.text == other.text
+
+    def __hash__(self):
+        return hash(self.text)
+
+    def __repr__(self):
+        return "RawJson({!r})".format(self.text)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def encode_json(value):
+    """
+    Encode a value to JSON as the Janrain API client does, with the RawJson
+    fragments spliced as they are. The API client sends a string parameter
+    without encoding it again.
+
+    Example:
+        >>> encode_json([{'a': RawJson('[{"b": 1}]'), 'c': None}])
+        '[{"a": [{"b": 1}], "c": null}]'
+    """
+    fragments = []
+
+    def placeholder(o):
+        if not isinstance(o, RawJson):
+            raise TypeError("Object of type {} is not JSON serializable"
+                            .format(type(o).__name__))
+        fragments.append(o.text)
+        return "\x00"
+
+    encoded = json.dumps(value, default=placeholder)
+    if not fragments:
+        return encoded
+    # A string of the data looking like a placeholder would be replaced too,
+    # the value is then encoded without placeholders.
+    parts = encoded.split(RAW_JSON_PLACEHOLDER)
+    if len(parts) != len(fragments) + 1:
+        return splice_json(value)
+    fragments.append(parts.pop())
+    return "".join(chain.from_iterable(zip(parts, fragments))) + fragments[-1]
+
+
+def splice_json(value):
+    """
+    Encode a value to JSON one object at a time, with the RawJson fragments
+    spliced as they are. This is slower than encode_json().
+    """
+    if isinstance(value, RawJson):
+        return value.text
+    elif isinstance(value, dict):
+        return "{{{}}}".format(", ".join(
+            "{}: {}".format(json.dumps(k), splice_json(v))
+            for k, v in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return "[{}]".format(", ".join(splice_json(v) for v in value))
+    return json.dumps(value)
+
+
 def expand_objects(record):
     """
     Expand attributes expressed in dot-notation and merge back into dictionary.
@@ -71,41 +192,133 @@ def expand_objects(record):
     return new_record
 
 
-def count_lines_in_file(file, ignore_header=True):
+def count_lines_in_file(file, ignore_header=True, quoted=False):
     """
-    Counts number of records in a file. This assumes each record is defined in
-    a single line. Similar but not limited to CSV files. By default, consider
-    and ignores the header row (First row) from the count.
+    Counts number of records in a file. By default this assumes each record is
+    defined in a single line. Similar but not limited to CSV files. By default,
+    consider and ignores the header row (First row) from the count.
+
+    The file is read in large binary blocks and the newlines are counted in
+    each block, without decoding or splitting the lines.
 
     Args:
         file - Path to file
         ignore_header - If True, ignores first line in count. If False, returns
         count of all lines in file
+        quoted - If True, newlines inside quoted CSV fields are not counted, so
+        that records spanning several lines are counted once
     """
+    count = 0
+    in_quotes = 0
+    last_byte = b"\n"
+    with open_data_file(file) as f:
+        for block in iter(lambda: f.read(COUNT_BLOCK_SIZE), b""):
+            if quoted:
+                # A line with an odd number of quotes enters or leaves a
+                # quoted field. The parity after each line tells if its
+                # newline is inside a quoted field, and the parity after the
+                # incomplete last line is carried over to the next block.
+                lines = block.split(b"\n")
+                odd_quotes = map(operator.and_,
+                                 map(bytes.count, lines, repeat(b'"')),
+                                 repeat(1))
+                parities = list(accumulate(odd_quotes, operator.xor,
+                                           initial=in_quotes))
+                count += parities[1:-1].count(0)
+                in_quotes = parities[-1]
+            else:
+                count += block.count(b"\n")
+            last_byte = block[-1:]
 
-    count = sum(1 for _ in open(file))
+    # The last line may not end with a newline.
+    if last_byte != b"\n":
+        count += 1
 
     if ignore_header:
         return count - 1
     return count
 
 
-def delete_file(file, logger):
-    if os.path.exists(file):
-        logger.info("Deleting file")
-        os.unlink(file)
+class StdinReader(io.RawIOBase):
+    """
+    Raw stream over the standard input in binary mode. The first bytes are
+    read when it is created, to detect the compression of the data, and are
+    returned again by the first reads.
+    """
+    def __init__(self):
+        super().__init__()
+        # Unlike peek(), read() waits until the bytes have all arrived on a
+        # pipe, or until its end.
+        self.signature = sys.stdin.buffer.read(SIGNATURE_SIZE)
+        self._head = self.signature
+
+    def readable(self):
+        return True
 
+    def readinto(self, b):
+        if self._head:
+            size = min(len(b), len(self._head))
+            b[:size] = self._head[:size]
+            self._head = self._head[size:]
+            return size
+        return sys.stdin.buffer.readinto1(b)
 
-def rate_limiter(start_time, min_execution_time):
+
+def get_stdin():
+    """
+    Returns the standard input in binary mode, see StdinReader.
     """
-    As a very crude rate limiting mechanism, sleep if processing the batch
-    did not use all of the minimum time.
+    global _stdin
+    if _stdin is None:
+        _stdin = io.BufferedReader(StdinReader())
+    return _stdin
 
-    Args:
-        start_time - to calculate the total amount of time spent.
-        min_time - the minimum time a api call should wait
+
+def get_compression(file):
     """
+    Detects if a file is compressed with gzip, bz2 or xz from its content.
+
+    Returns:
+        The function to open the compressed file, or None if the file is not
+        compressed.
+    """
+    if file == STDIN:
+        magic = get_stdin().raw.signature
+    else:
+        with open(file, "rb") as f:
+            magic = f.read(SIGNATURE_SIZE)
+    for signature, open_function in COMPRESSION_FORMATS:
+        if magic.startswith(signature):
+            return open_function
+    return None
+
+
+def open_binary_file(file):
+    """
+    Opens a file for reading in binary mode, or the standard input if the
+    file name is "-".
+    """
+    if file == STDIN:
+        return get_stdin()
+    return open(file, "rb")
+
+
+def open_data_file(file):
+    """
+    Opens a data file for reading in binary mode, or the standard input if the
+    file name is "-". Data compressed with gzip, bz2 or xz is decompressed on
+    the fly.
+    """
+    open_function = get_compression(file)
+    if file == STDIN:
+        if open_function:
+            return open_function(get_stdin(), "rb")
+        return get_stdin()
+    return (open_function or open)(file, "rb")
+
+
+def delete_file(file, logger):
+    if os.path.exists(file):
+        logger.info("Deleting file")
+        os.unlink(file)
 
-    execution_time = time.time() - start_time
-    if execution_time < min_execution_time:
-        time.sleep(min_execution_time - execution_time)